@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Micro-benchmarks of the pure python hot paths in netman and http_server,
+# against the synthetic NetworkManager in synthetic.py.
+#
+# Each benchmark reports ops/sec and the peak python memory allocated per
+# op (tracemalloc), and is checked against budgets.json:
+#   min_ops_per_sec      - fails if slower
+#   max_peak_bytes       - fails if it allocates more per op
+# Benchmarks run at growing input sizes; "scaling" budgets check that the
+# time per item at the largest size is at most max_ratio times that at the
+# smallest, so an O(n^2) loop shows up however fast the machine is.
+#
+#   python3 benchmarks/run.py               run all, exit 1 on a regression
+#   python3 benchmarks/run.py -k networks   only benchmarks matching
+#   python3 benchmarks/run.py --update      write budgets from this machine
+#
+# ops/sec budgets depend on the machine, regenerate them with --update on
+# the hardware you care about (they're set to a third of what it measures).
+
+import argparse, gc, io, json, os, sys, time, tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+# Before our modules read their config: no activation history file, only
+# errors logged, a fixed gateway so nothing goes looking for it, no cap on
+# the APs we keep and the synthetic backend rather than D-Bus.
+os.environ['ACTIVATION_HISTORY'] = ''
+os.environ['LOG_LEVEL'] = 'ERROR'
+os.environ['DEFAULT_GATEWAY'] = '192.168.42.1'
+os.environ['MAX_ACCESS_POINTS'] = '0'
+os.environ['NM_ASYNC'] = '0'
+
+import netman
+import http_server
+import synthetic
+
+BUDGETS = os.path.join(HERE, 'budgets.json')
+SIZES = (10, 100, 1000)
+UPDATE_SPEED_FACTOR = 0.33 # --update allows a third of the measured speed
+UPDATE_MEMORY_FACTOR = 1.5 # and half as much again memory
+UPDATE_SCALING_RATIO = 3.0
+
+
+#------------------------------------------------------------------------------
+# The benchmarks.  Each is a function of the input size returning the
+# callable to time; the setup (outside the callable) isn't measured.
+def bench_classify_security(n):
+    netman.set_backend(synthetic.Backend(0))
+    flags = [synthetic.SECURITY_FLAGS[i % len(synthetic.SECURITY_FLAGS)]
+             for i in range(n)]
+    def run():
+        for f, wpa, rsn in flags:
+            netman.classify_security(f, wpa, rsn)
+    return run
+
+
+def bench_access_points(n):
+    netman.set_backend(synthetic.Backend(n))
+    return netman.get_list_of_access_points
+
+
+# The device comes up as soon as it's activated, so this is building the
+# settings dict and the calls around it.
+def bench_connect_dict(n):
+    netman.set_backend(synthetic.Backend(0))
+    types = [netman.CONN_TYPE_SEC_NONE, netman.CONN_TYPE_SEC_PASSWORD,
+             netman.CONN_TYPE_SEC_ENTERPRISE, netman.CONN_TYPE_HOTSPOT]
+    def run():
+        for i in range(n):
+            netman.connect_to_AP(types[i % len(types)],
+                    ssid='net-{}'.format(i), username='user',
+                    password='secret')
+    return run
+
+
+# A server on an ephemeral port, never started; we only use its methods.
+_server = None
+
+def get_server():
+    global _server
+    if _server is None:
+        _server = http_server.MyHTTPServer('.', ('127.0.0.1', 0), None)
+    return _server
+
+
+def bench_networks_json(n):
+    netman.set_backend(synthetic.Backend(n))
+    ssids = netman.get_list_of_access_points()
+    # alternate between two lists so every call has a diff to publish
+    other = ssids[1:]
+    server = get_server()
+    def run():
+        server.set_networks(ssids)
+        server.set_networks(other)
+    return run
+
+
+# A socket stand in for the request handler: reads the request from a
+# buffer, throws the response away.
+class FakeConnection(object):
+    def __init__(self, request):
+        self.request = request
+        self.sent = 0
+
+    def makefile(self, mode, *args):
+        return io.BytesIO(self.request)
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+
+def bench_request(n):
+    netman.set_backend(synthetic.Backend(n))
+    server = get_server()
+    server.set_networks(netman.get_list_of_access_points())
+    handler = http_server.RequestHandlerClassFactory('127.0.0.1', 'code')
+    request = (b'GET /networks HTTP/1.1\r\nHost: 192.168.42.1\r\n'
+               b'Connection: close\r\n\r\n')
+    def run():
+        handler(FakeConnection(request), ('127.0.0.1', 1234), server)
+    return run
+
+
+# (name, benchmark, input sizes, whether its time should grow linearly
+# with the size).  A request for /networks sends the body set_networks()
+# made, so it shouldn't grow at all.
+BENCHMARKS = [
+    ('classify_security', bench_classify_security, SIZES, True),
+    ('access_points', bench_access_points, SIZES, True),
+    ('connect_dict', bench_connect_dict, (1, 10), True),
+    ('networks_json', bench_networks_json, SIZES, True),
+    ('request_networks', bench_request, (10, 1000), False),
+]
+
+
+#------------------------------------------------------------------------------
+# Best ops/sec of repeat runs, each of at least min_time seconds.
+def measure_speed(func, min_time=0.1, repeat=3):
+    func() # warm up
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else \
+                max(2, int(min_time / elapsed * 1.2))
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return number / best
+
+
+# Peak bytes python allocated during one op.
+def measure_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        func()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(pattern=None, quick=False):
+    results = {}
+    for name, bench, sizes, linear in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        for n in sizes:
+            func = bench(n)
+            ops = measure_speed(func, 0.02 if quick else 0.1)
+            peak = measure_memory(func)
+            key = '{}[{}]'.format(name, n)
+            results[key] = {'name': name, 'size': n, 'n': n if linear else 1,
+                            'ops_per_sec': ops, 'peak_bytes': peak}
+            print('{:28} {:>12.1f} ops/s {:>10.1f} KiB peak'.format(
+                    key, ops, peak / 1024.0))
+    return results
+
+
+# Time per item at the largest size over that at the smallest (per op for
+# the benchmarks that shouldn't grow).
+def scaling_ratios(results):
+    by_name = {}
+    for r in results.values():
+        by_name.setdefault(r['name'], []).append(r)
+    ratios = {}
+    for name, runs in by_name.items():
+        if len(runs) < 2:
+            continue
+        runs.sort(key=lambda r: r['size'])
+        small, large = runs[0], runs[-1]
+        per_item = lambda r: 1.0 / (r['ops_per_sec'] * r['n'])
+        ratios[name] = per_item(large) / per_item(small)
+    return ratios
+
+
+def check(results, budgets):
+    failures = []
+    for key, r in sorted(results.items()):
+        budget = budgets.get('benchmarks', {}).get(key)
+        if not budget:
+            continue
+        if r['ops_per_sec'] < budget.get('min_ops_per_sec', 0):
+            failures.append('{}: {:.1f} ops/s, budget {:.1f}'.format(key,
+                    r['ops_per_sec'], budget['min_ops_per_sec']))
+        if 'max_peak_bytes' in budget and \
+                r['peak_bytes'] > budget['max_peak_bytes']:
+            failures.append('{}: {} bytes peak, budget {}'.format(key,
+                    r['peak_bytes'], budget['max_peak_bytes']))
+    for name, ratio in sorted(scaling_ratios(results).items()):
+        print('{:28} {:.2f}x the time per item'.format(name, ratio))
+        budget = budgets.get('scaling', {}).get(name)
+        if budget and ratio > budget['max_ratio']:
+            failures.append('{}: time per item grows {:.2f}x, budget '
+                    '{:.2f}x'.format(name, ratio, budget['max_ratio']))
+    return failures
+
+
+def update(results):
+    budgets = {'benchmarks': {}, 'scaling': {}}
+    for key, r in sorted(results.items()):
+        budgets['benchmarks'][key] = {
+            'min_ops_per_sec': round(r['ops_per_sec'] * UPDATE_SPEED_FACTOR, 1),
+            'max_peak_bytes': int(r['peak_bytes'] * UPDATE_MEMORY_FACTOR) + 1024,
+        }
+    for name, ratio in sorted(scaling_ratios(results).items()):
+        print('{:28} {:.2f}x the time per item'.format(name, ratio))
+        budgets['scaling'][name] = {
+            'max_ratio': round(max(UPDATE_SCALING_RATIO, ratio * 1.5), 2)}
+    with open(BUDGETS, 'w') as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Wrote {}'.format(BUDGETS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='netman / http_server '
+            'micro-benchmarks')
+    parser.add_argument('-k', dest='pattern', help='only benchmarks '
+            'whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='shorter runs')
+    parser.add_argument('--update', action='store_true', help='write '
+            'budgets.json from this run')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.pattern, args.quick)
+    if args.update:
+        update(results)
+        return 0
+
+    with open(BUDGETS) as f:
+        budgets = json.load(f)
+    failures = check(results, budgets)
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# A synthetic NetworkManager backend for the benchmarks, installed with
+# netman.set_backend().  Everything is plain python objects, so what we
+# measure is our code, not D-Bus.
+
+import random
+
+NM_DEVICE_TYPE_WIFI = 2
+NM_DEVICE_STATE_ACTIVATED = 100
+NM_STATE_CONNECTED_GLOBAL = 70
+NM_802_11_AP_FLAGS_PRIVACY = 0x1
+NM_802_11_AP_SEC_NONE = 0x0
+NM_802_11_AP_SEC_KEY_MGMT_PSK = 0x100
+NM_802_11_AP_SEC_KEY_MGMT_802_1X = 0x200
+
+# (flags, wpa flags, rsn flags) of an open, WEP, WPA, WPA2 and enterprise AP.
+SECURITY_FLAGS = [
+    (0x0, 0x0, 0x0),
+    (0x1, 0x0, 0x0),
+    (0x1, 0x100, 0x0),
+    (0x1, 0x0, 0x100),
+    (0x1, 0x0, 0x200),
+]
+
+
+class AccessPoint(object):
+    def __init__(self, ssid, flags, wpa_flags, rsn_flags, strength):
+        self.Ssid = ssid
+        self.Flags = flags
+        self.WpaFlags = wpa_flags
+        self.RsnFlags = rsn_flags
+        self.Strength = strength
+        self.object_path = '/ap/' + ssid
+
+
+# Comes up the moment it's asked to: reads as disconnected, except right
+# after ActivateConnection().
+NM_DEVICE_STATE_DISCONNECTED = 30
+
+class Device(object):
+    DeviceType = NM_DEVICE_TYPE_WIFI
+    WirelessCapabilities = 0x40
+    Mode = 2
+    Bitrate = 54000
+
+    def __init__(self, interface, aps):
+        self.Interface = interface
+        self.object_path = '/dev/' + interface
+        self.aps = aps
+        self.activating = False
+
+    @property
+    def State(self):
+        if self.activating:
+            self.activating = False
+            return NM_DEVICE_STATE_ACTIVATED
+        return NM_DEVICE_STATE_DISCONNECTED
+
+    def GetAccessPoints(self):
+        return self.aps
+
+
+class Connection(object):
+    def __init__(self, settings, path):
+        self.settings = settings
+        self.object_path = path
+
+    def GetSettings(self):
+        return self.settings
+
+    def Delete(self):
+        pass
+
+
+class _Settings(object):
+    def __init__(self):
+        self.added = 0
+
+    def ListConnections(self):
+        return []
+
+    def AddConnection(self, settings):
+        self.added += 1
+        return Connection(settings, '/conn/{}'.format(self.added))
+
+
+class _NetworkManager(object):
+    State = NM_STATE_CONNECTED_GLOBAL
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def GetDevices(self):
+        return self.devices
+
+    def ActivateConnection(self, conn, dev, specific):
+        dev.activating = True
+        return None
+
+    def OnStateChanged(self, callback):
+        pass
+
+
+# An AP list like a dense RF environment: n APs, about one in three a
+# duplicate SSID (mesh / several bands), mixed security types.
+def make_access_points(n, seed=1):
+    rng = random.Random(seed)
+    names = max(1, n * 2 // 3)
+    return [AccessPoint('net-{}'.format(rng.randrange(names)),
+                        *rng.choice(SECURITY_FLAGS),
+                        strength=rng.randrange(100))
+            for _ in range(n)]
+
+
+# A module-like backend with one wifi device seeing n APs.
+class Backend(object):
+    def __init__(self, n_aps=0):
+        for name, value in globals().items():
+            if name.startswith('NM_'):
+                setattr(self, name, value)
+        self.device = Device('wlan0', make_access_points(n_aps))
+        self.NetworkManager = _NetworkManager([self.device])
+        self.Settings = _Settings()
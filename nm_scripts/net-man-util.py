@@ -18,15 +18,21 @@ Actions:
   enable     - Enable specific connection types
   disable    - Disable specific connection types
   dump       - Dump connection info
-  info       - Information about a connection"""
+  info       - Information about a connection
+  visible    - List the visible access points
+  snapshot   - Print devices, access points and connections as one JSON
+               document, with the time each section took"""
 
 import datetime
+import dbus
 from dbus.exceptions import DBusException
+import json
 import NetworkManager
 import optparse
 import socket
 import struct
 import sys
+import time
 
 PY3 = sys.version_info[0] >= 3
 
@@ -47,6 +53,9 @@ def main():
     elif args[0] == 'visible':
         visible()
 
+    elif args[0] == 'snapshot':
+        snapshot()
+
     elif len(args) < 2:
         p.print_help()
         sys.exit(1)
@@ -74,14 +83,17 @@ def main():
         sys.exit(1)
 
 def list_():
-    active = [x.Connection.GetSettings()['connection']['id']
-              for x in NetworkManager.NetworkManager.ActiveConnections]
-    connections = [(x.GetSettings()['connection']['id'], x.GetSettings()['connection']['type'])
-                   for x in NetworkManager.Settings.ListConnections()]
+    active = set(x.Connection.object_path
+                 for x in NetworkManager.NetworkManager.ActiveConnections)
+    connections = []
+    for x in NetworkManager.Settings.ListConnections():
+        settings = x.GetSettings()['connection']
+        connections.append((settings['id'], settings['type'],
+                            x.object_path in active))
     fmt = "%%s %%-%ds    %%s" % max([len(x[0]) for x in connections])
     for conn in sorted(connections):
-        prefix = '* ' if conn[0] in active else '  '
-        print(mt % (prefix, conn[0], conn[1]))
+        prefix = '* ' if conn[2] else '  '
+        print(fmt % (prefix, conn[0], conn[1]))
 
 def activate(names):
     connections = NetworkManager.Settings.ListConnections()
@@ -229,5 +241,158 @@ def visible():
             prefix = '* ' if ap.object_path == active.object_path else '  '
             print("%s %s" % (prefix, ap.Ssid))
 
+# The snapshot reads properties in bulk with raw D-Bus calls instead of one
+# property at a time through the NetworkManager module.
+NM_BUS_NAME = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_IFACE = 'org.freedesktop.NetworkManager'
+PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+OBJECT_MANAGER_IFACE = 'org.freedesktop.DBus.ObjectManager'
+SETTINGS_PATH = NM_PATH + '/Settings'
+SETTINGS_CONN_IFACE = NM_IFACE + '.Settings.Connection'
+
+# Object path prefix -> (snapshot section, interfaces to read).
+SNAPSHOT_OBJECTS = [
+    (NM_PATH + '/Devices/', 'devices',
+        [NM_IFACE + '.Device', NM_IFACE + '.Device.Wireless']),
+    (NM_PATH + '/AccessPoint/', 'access_points', [NM_IFACE + '.AccessPoint']),
+    (NM_PATH + '/ActiveConnection/', 'active_connections',
+        [NM_IFACE + '.Connection.Active']),
+]
+
+# What older NM answers to GetManagedObjects.
+NO_OBJECT_MANAGER = (
+    'org.freedesktop.DBus.Error.UnknownMethod',
+    'org.freedesktop.DBus.Error.UnknownObject',
+    'org.freedesktop.DBus.Error.UnknownInterface',
+)
+
+# Byte array properties / settings that are really strings.
+SNAPSHOT_STRINGS = ('Ssid', 'ssid')
+
+def to_plain(value, key=None):
+    """Convert dbus types to things json can write."""
+    if isinstance(value, dbus.Array) and value.signature == 'y':
+        data = bytes(bytearray(int(x) for x in value))
+        if key in SNAPSHOT_STRINGS:
+            return data.decode('utf-8', 'replace')
+        return list(bytearray(data))
+    if isinstance(value, dict):
+        return dict((str(k), to_plain(v, str(k))) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_plain(v) for v in value]
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, (dbus.ObjectPath, dbus.String)):
+        return str(value)
+    if isinstance(value, dbus.Double):
+        return float(value)
+    if isinstance(value, (int, dbus.Byte)):
+        return int(value)
+    return value
+
+class Snapshot(object):
+    """Bulk reads of NetworkManager state, counting D-Bus calls and timing
+    each section."""
+
+    def __init__(self):
+        self.bus = dbus.SystemBus()
+        self.calls = 0
+        self.timings = {}
+
+    def call(self, path, iface, method, *args):
+        self.calls += 1
+        obj = self.bus.get_object(NM_BUS_NAME, path)
+        return getattr(obj, method)(*args, dbus_interface=iface)
+
+    def timed(self, section, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[section] = round(time.time() - start, 4)
+
+    def managed_objects(self):
+        """Every NM object and its properties, by path.  One call where NM
+        has an ObjectManager (1.12 and later), otherwise GetAll per object."""
+        try:
+            return self.call('/org/freedesktop', OBJECT_MANAGER_IFACE,
+                             'GetManagedObjects')
+        except DBusException as e:
+            if e.get_dbus_name() not in NO_OBJECT_MANAGER:
+                raise
+        return self.walk_objects()
+
+    def walk_objects(self):
+        objects = {}
+
+        def get_all(path, ifaces):
+            props = objects.setdefault(path, {})
+            for iface in ifaces:
+                try:
+                    props[iface] = self.call(path, PROPS_IFACE, 'GetAll', iface)
+                except DBusException:
+                    pass # e.g. Device.Wireless on an ethernet device
+
+        get_all(NM_PATH, [NM_IFACE])
+        manager = objects[NM_PATH][NM_IFACE]
+        get_all(SETTINGS_PATH, [NM_IFACE + '.Settings'])
+        for path in manager.get('AllDevices', manager.get('Devices', [])):
+            get_all(path, SNAPSHOT_OBJECTS[0][2])
+            wireless = objects[path].get(NM_IFACE + '.Device.Wireless', {})
+            for ap in wireless.get('AccessPoints', []):
+                get_all(ap, SNAPSHOT_OBJECTS[1][2])
+        for path in manager.get('ActiveConnections', []):
+            get_all(path, SNAPSHOT_OBJECTS[2][2])
+        return objects
+
+    def settings(self, objects):
+        """The settings of every connection.  Settings aren't properties, so
+        this is one GetSettings call per connection."""
+        settings = objects.get(SETTINGS_PATH, {}).get(NM_IFACE + '.Settings')
+        if settings is not None:
+            paths = settings.get('Connections', [])
+        else:
+            paths = self.call(SETTINGS_PATH, NM_IFACE + '.Settings',
+                              'ListConnections')
+        return dict((path, self.call(path, SETTINGS_CONN_IFACE, 'GetSettings'))
+                    for path in paths)
+
+    def build(self, objects, settings):
+        manager = objects.get(NM_PATH, {}).get(NM_IFACE, {})
+        doc = {'manager': to_plain(manager)}
+        for prefix, section, ifaces in SNAPSHOT_OBJECTS:
+            entries = []
+            for path in sorted(objects):
+                if not path.startswith(prefix):
+                    continue
+                entry = {'path': str(path)}
+                for iface in ifaces:
+                    entry.update(to_plain(objects[path].get(iface, {})))
+                entries.append(entry)
+            doc[section] = entries
+
+        active = set(str(x.get('Connection')) for x in doc['active_connections'])
+        doc['connections'] = [
+            {'path': str(path), 'active': str(path) in active,
+             'settings': to_plain(settings[path])}
+            for path in sorted(settings)]
+        return doc
+
+    def run(self):
+        start = time.time()
+        objects = self.timed('objects', self.managed_objects)
+        settings = self.timed('settings', self.settings, objects)
+        doc = self.timed('build', self.build, objects, settings)
+        doc['time'] = start
+        doc['dbus_calls'] = self.calls
+        self.timings['total'] = round(time.time() - start, 4)
+        doc['timings'] = self.timings
+        return doc
+
+def snapshot():
+    json.dump(Snapshot().run(), sys.stdout, indent=2, sort_keys=True)
+    print()
+
 if __name__ == '__main__':
     main()
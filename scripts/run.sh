@@ -6,6 +6,10 @@
 #  -u <UI directory to serve>   Default: "../ui"
 #  -d Delete Connections First  Default: False
 #  -r Device Registration Code  Default: ""
+#  -D Daemon mode, stay resident Default: False
+#  -g <Portal grace period secs> Default: 30
+#  --profile-startup            Print import and startup timings
+#  --profile-memory             Print memory use per phase
 #  -h Show help.
 
 # Check OS we are running on.  NetworkManager only works on Linux.
@@ -19,13 +23,9 @@ TOPDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )/.." && pwd )"
 # The top of our source tree is the parent of this scripts dir
 cd $TOPDIR
 
-# Introduced in supervisor v1.6. Returns the current device state
-export BALENA_SUPERVISOR_DEVICE="$BALENA_SUPERVISOR_ADDRESS/v1/device?apikey=$BALENA_SUPERVISOR_API_KEY"
-printf "curl -X GET --header \"Content-Type:application/json\" %s/v1/device?apikey=%s" $BALENA_SUPERVISOR_ADDRESS $BALENA_SUPERVISOR_API_KEY
-export BALENA_SUPERVISOR_DEVICE=$(curl -X GET --header "Content-Type:application/json" $BALENA_SUPERVISOR_DEVICE)
-
-# Sometimes it takes a couple of seconds to connect the wifi,..
-sleep 15
+# The application asks the balena supervisor for the device info itself
+# (see src/supervisor.py), and waits up to AUTOCONNECT_WAIT seconds
+# (default 15) for NetworkManager to finish connecting the wifi at boot.
 
 # Use the venv
 source $TOPDIR/venv/bin/activate
@@ -0,0 +1,130 @@
+# How long to wait for a connection to come up, learned from how long it
+# took before.
+#
+# Our hotspot is up in a couple of seconds, an enterprise (PEAP) network can
+# take 20.  So instead of one fixed wait, we keep the last activation times
+# per connection type and SSID in a small JSON file, and wait for a high
+# percentile of those plus a margin, between a floor and a ceiling.  With
+# too little history we fall back to what other SSIDs of the same type
+# took, then to the default.  If the last attempt on an SSID ran out of
+# time, it gets the ceiling next time, in case it's just slow.
+
+import json, os, threading
+
+import config
+import log
+
+logger = log.get('activation')
+
+MAX_SAMPLES = 20 # per connection type and SSID
+MIN_SAMPLES = 3 # before we trust the history
+PERCENTILE = 90
+MARGIN_FACTOR = 1.5
+MARGIN_SECS = 2.0
+
+
+#------------------------------------------------------------------------------
+# Nearest rank percentile of a sorted list, None if it's empty.  The signal
+# stats in sampler.py use it too.
+def percentile(values, pct):
+    if not values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+#------------------------------------------------------------------------------
+class ActivationHistory(object):
+
+    def __init__(self, path=None, floor=5.0, ceiling=60.0, default=30.0):
+        self.path = path
+        self.floor = floor
+        self.ceiling = ceiling
+        self.default = default
+        self._lock = threading.Lock()
+        # 'type\nssid' -> {'secs': [durations], 'timed_out': bool}
+        self._entries = self._load()
+
+    @staticmethod
+    def _key(conn_type, ssid):
+        return '{}\n{}'.format(conn_type, ssid)
+
+    # The saved entries, leaving out any that don't look like ours (a hand
+    # edited or older file) rather than failing on them later.
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        valid = {}
+        for key, entry in entries.items():
+            try:
+                secs = [float(s) for s in entry['secs']][-MAX_SAMPLES:]
+                valid[key] = {'secs': secs,
+                              'timed_out': bool(entry.get('timed_out'))}
+            except (AttributeError, KeyError, TypeError, ValueError):
+                logger.warning('Ignoring bad activation history entry %r',
+                        key)
+        return valid
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning('Unable to save the activation history: %s', e)
+
+    # Seconds to wait for a connection of this type to SSID to activate.
+    def timeout(self, conn_type, ssid):
+        with self._lock:
+            entry = self._entries.get(self._key(conn_type, ssid))
+            if entry and entry.get('timed_out'):
+                return self.ceiling
+            samples = entry['secs'] if entry else []
+            if len(samples) < MIN_SAMPLES:
+                prefix = self._key(conn_type, '')
+                samples = [secs for key, other in self._entries.items()
+                           if key.startswith(prefix) for secs in other['secs']]
+        if len(samples) < MIN_SAMPLES:
+            return self.default
+        secs = percentile(sorted(samples), PERCENTILE) * MARGIN_FACTOR + \
+                MARGIN_SECS
+        return min(self.ceiling, max(self.floor, secs))
+
+    # How an attempt went: secs it took to activate, or None if we gave up
+    # waiting for it.  Attempts that failed outright say nothing about the
+    # time needed and aren't recorded.
+    def record(self, conn_type, ssid, secs):
+        with self._lock:
+            entry = self._entries.setdefault(self._key(conn_type, ssid),
+                    {'secs': [], 'timed_out': False})
+            entry['timed_out'] = secs is None
+            if secs is not None:
+                entry['secs'] = (entry['secs'] + [round(secs, 2)])[-MAX_SAMPLES:]
+            self._save()
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+#------------------------------------------------------------------------------
+# The process wide history, from config.
+def get():
+    global _history
+    with _history_lock:
+        if _history is None:
+            cfg = config.get()
+            _history = ActivationHistory(cfg.activation_history,
+                    cfg.activation_floor, cfg.activation_ceiling,
+                    cfg.activation_default)
+        return _history
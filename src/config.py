@@ -0,0 +1,127 @@
+# Runtime configuration shared by netman, dnsmasq and the http server.
+# Everything is read from the environment once, the first time get() is
+# called.  Anything that needs a lookup (e.g. the gateway address) is only
+# resolved when something actually asks for it.
+
+import os
+
+# Used when DEFAULT_GATEWAY is not set and we can't discover the host IP.
+FALLBACK_GATEWAY = '192.168.42.1'
+
+
+#------------------------------------------------------------------------------
+# Our configuration values.  Construct with a dict to override the
+# environment (e.g. from a test or a script).
+class Config(object):
+
+    def __init__(self, env=None):
+        if env is None:
+            env = os.environ
+
+        # use 'ip link show | grep qlen' to see list of interfaces
+        self.interface = env.get('DEFAULT_INTERFACE', 'wlan0')
+        # Units with two radios (e.g. onboard chip + USB dongle) can run the
+        # hotspot on one interface and keep scanning / connecting on the
+        # other.  Set either to 'auto' to pick the device by capability.
+        self.ap_interface = env.get('AP_INTERFACE', self.interface)
+        self.sta_interface = env.get('STA_INTERFACE', self.ap_interface)
+
+        self.dhcp_range = env.get('DEFAULT_DHCP_RANGE',
+                '192.168.42.2,192.168.42.254')
+        # Where dnsmasq's config, hosts and lease files live.
+        self.dnsmasq_dir = env.get('DNSMASQ_DIR', '/tmp/wifi-connect-dnsmasq')
+        self.disable_hotspot = bool(int(env.get('DISABLE_HOTSPOT', 0)))
+        self.device_name = env.get('RESIN_DEVICE_NAME_AT_INIT', 'aged-cheese')
+
+        # Daemon mode: stay resident after connecting and bring the portal
+        # back when the uplink has been down for grace_period seconds.
+        self.daemon = bool(int(env.get('DAEMON_MODE', 0)))
+        self.grace_period = int(env.get('PORTAL_GRACE_PERIOD', 30))
+
+        # Longest we wait at startup for NetworkManager to finish bringing up
+        # a saved connection before deciding we're offline.
+        self.autoconnect_wait = float(env.get('AUTOCONNECT_WAIT', 15))
+
+        # Most APs we keep (the strongest), to bound memory in dense RF
+        # environments.  0 for no limit.
+        self.max_access_points = int(env.get('MAX_ACCESS_POINTS', 50))
+
+        # Password for the /admin/ endpoints, which are off when it's unset.
+        self.admin_token = env.get('ADMIN_TOKEN')
+
+        # Record the NetworkManager D-Bus traffic to, or replay it from, a
+        # trace file (see nmtrace.py).  NM_TRACE_SPEED scales replay latency.
+        self.nm_trace_record = env.get('NM_TRACE_RECORD')
+        self.nm_trace_replay = env.get('NM_TRACE_REPLAY')
+        self.nm_trace_speed = float(env.get('NM_TRACE_SPEED', 1.0))
+
+        # Signal history of the AP we're connected to (see sampler.py):
+        # seconds between samples (0 turns it off) and how many we keep.
+        self.signal_interval = float(env.get('SIGNAL_SAMPLE_INTERVAL', 10))
+        self.signal_samples = int(env.get('SIGNAL_SAMPLES', 360))
+
+        # Connection attempts (see scheduler.py): each client may make
+        # connect_burst attempts, plus one every connect_interval seconds,
+        # and connect_queue attempts may wait for the running one.
+        self.connect_interval = float(env.get('CONNECT_INTERVAL', 30))
+        self.connect_burst = int(env.get('CONNECT_BURST', 3))
+        self.connect_queue = int(env.get('CONNECT_QUEUE', 1))
+
+        # The balena supervisor (see supervisor.py), and where and for how
+        # long we cache what it tells us.
+        self.supervisor_address = env.get('BALENA_SUPERVISOR_ADDRESS')
+        self.supervisor_api_key = env.get('BALENA_SUPERVISOR_API_KEY')
+        self.supervisor_cache = env.get('SUPERVISOR_CACHE',
+                '/tmp/wifi-connect-supervisor.json')
+        self.supervisor_ttl = int(env.get('SUPERVISOR_CACHE_TTL', 300))
+        self.supervisor_timeout = float(env.get('SUPERVISOR_TIMEOUT', 5))
+
+        # How long to wait for a connection to activate (see activation.py):
+        # learned from the history file, between the floor and ceiling, or
+        # the default until there's enough history.
+        self.activation_history = env.get('ACTIVATION_HISTORY',
+                '/tmp/wifi-connect-activation.json')
+        self.activation_floor = float(env.get('ACTIVATION_TIMEOUT_MIN', 5))
+        self.activation_ceiling = float(env.get('ACTIVATION_TIMEOUT_MAX', 60))
+        self.activation_default = float(env.get('ACTIVATION_TIMEOUT', 30))
+
+        # Rescans for /networks/refresh are at least this many seconds apart
+        # (see scanner.py).
+        self.scan_min_interval = float(env.get('SCAN_MIN_INTERVAL', 30))
+
+        # Logging (see log.py): level name, 'text' or 'json', and how many
+        # records may wait for the writer before new ones are dropped.
+        self.log_level = env.get('LOG_LEVEL', 'INFO').upper()
+        self.log_format = env.get('LOG_FORMAT', 'text').lower()
+        self.log_queue_size = int(env.get('LOG_QUEUE_SIZE', 1000))
+
+        # Use the asyncio D-Bus client (nmasync.py) where it helps, when
+        # dbus-next is installed.
+        self.nm_async = bool(int(env.get('NM_ASYNC', 1)))
+
+        # Idle seconds before the HTTP server closes a kept-alive connection.
+        self.keepalive_timeout = int(env.get('HTTP_KEEPALIVE_TIMEOUT', 10))
+
+        self._gateway = env.get('DEFAULT_GATEWAY')
+
+    # The hotspot / HTTP server address.  Only discovered (from the balena
+    # supervisor or a hostname lookup) if DEFAULT_GATEWAY isn't set, and
+    # then we wait at most supervisor_timeout for the supervisor.
+    @property
+    def gateway(self):
+        if self._gateway is None:
+            import netman # imports config, so not at the top
+            self._gateway = netman.bln_device_fetch() or FALLBACK_GATEWAY
+        return self._gateway
+
+
+_config = None
+
+
+#------------------------------------------------------------------------------
+# Return the process wide configuration, created on first use.
+def get():
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
@@ -1,44 +1,227 @@
-# start / stop the dnsmasq process
+# start / stop / reconfigure the dnsmasq process
+#
+# dnsmasq is driven by a config file we render into config.dnsmasq_dir.
+# The portal starts dnsmasq with the hotspot and stops it with the hotspot,
+# so each portal cycle is a fresh start.  The lease file is kept in the
+# same directory, so a new cycle doesn't make every phone DHCP again.
+# apply() on a dnsmasq that is still running only restarts it for settings
+# read at startup (interface, listen address, DHCP range); the hosts and
+# DHCP options are in files it re-reads on SIGHUP.
 
-import subprocess, time, os
+import subprocess, time, os, signal
 
-DEFAULT_GATEWAY=os.getenv("DEFAULT_GATEWAY", "192.168.42.1")
-DEFAULT_DHCP_RANGE=os.getenv("DEFAULT_DHCP_RANGE","192.168.42.2,192.168.42.254")
-DEFAULT_INTERFACE=os.getenv('DEFAULT_INTERFACE',"wlan0") # use 'ip link show' to see list of interfaces
+import config
+import log
 
+logger = log.get('dnsmasq')
+
+
+#------------------------------------------------------------------------------
+# Everything dnsmasq needs to know, rendered into its config files.
+class DnsmasqConfig(object):
+
+    # Only read by dnsmasq at startup, changing these needs a restart.
+    RESTART_FIELDS = ('interface', 'gateway', 'dhcp_range')
+
+    # hosts is a dict of host name -> IP address.
+    # dhcp_options is a list of extra dhcp-option values, e.g. 'option:ntp-server,192.168.42.1'
+    def __init__(self, interface, gateway, dhcp_range, hosts=None, \
+            dhcp_options=None):
+        self.interface = interface
+        self.gateway = gateway
+        self.dhcp_range = dhcp_range
+        self.hosts = dict(hosts or {})
+        self.dhcp_options = list(dhcp_options or [])
+
+    def needs_restart(self, other):
+        return other is None or any(getattr(self, f) != getattr(other, f)
+                for f in self.RESTART_FIELDS)
+
+    # The main config file, paths is a dict of the file paths we write.
+    def render_conf(self, paths):
+        lines = [
+            # everything resolves to us, so the captured portal pops up
+            'address=/#/{}'.format(self.gateway),
+            'listen-address={}'.format(self.gateway),
+            'interface={}'.format(self.interface),
+            'except-interface=lo',
+            'bind-interfaces',
+            'dhcp-range={}'.format(self.dhcp_range),
+            'dhcp-authoritative',
+            'dhcp-leasefile={}'.format(paths['leases']),
+            'dhcp-optsfile={}'.format(paths['opts']),
+            'no-hosts',
+            'addn-hosts={}'.format(paths['hosts']),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def render_hosts(self):
+        return ''.join('{} {}\n'.format(ip, name)
+                for name, ip in sorted(self.hosts.items()))
+
+    def render_opts(self):
+        options = ['option:router,{}'.format(self.gateway),
+                   # RFC 8910 captive portal URI
+                   '114,"http://{}/"'.format(self.gateway)]
+        return '\n'.join(options + self.dhcp_options) + '\n'
+
+
+_process = None # our running dnsmasq
+_current = None # the DnsmasqConfig it is running with
+
+STOP_WAIT_SECS = 5 # before we SIGKILL a dnsmasq that won't stop
+
+
+#------------------------------------------------------------------------------
+# Paths of the files we render / dnsmasq writes.
+def get_paths():
+    run_dir = config.get().dnsmasq_dir
+    return {
+        'conf': os.path.join(run_dir, 'dnsmasq.conf'),
+        'hosts': os.path.join(run_dir, 'hosts'),
+        'opts': os.path.join(run_dir, 'dhcp-opts'),
+        'leases': os.path.join(run_dir, 'dnsmasq.leases'),
+        'pid': os.path.join(run_dir, 'dnsmasq.pid'),
+    }
+
+
+#------------------------------------------------------------------------------
+# Build the config from our settings.
+# interface is the one our hotspot runs on, which may differ from
+# DEFAULT_INTERFACE on units with two radios.
+def build_config(interface=None):
+    cfg = config.get()
+    if interface is None:
+        interface = cfg.interface
+    return DnsmasqConfig(interface, cfg.gateway, cfg.dhcp_range)
+
+
+#------------------------------------------------------------------------------
+# Write the config files.  Safe to call ahead of time (e.g. while the
+# hotspot is still starting), dnsmasq only reads them on start or SIGHUP.
+def prepare(dns_config):
+    paths = get_paths()
+    os.makedirs(os.path.dirname(paths['conf']), exist_ok=True)
+    _write(paths['hosts'], dns_config.render_hosts())
+    _write(paths['opts'], dns_config.render_opts())
+    if dns_config.needs_restart(_current):
+        _write(paths['conf'], dns_config.render_conf(paths))
+
+
+# Replace the file in one go, so dnsmasq never reads half of it.
+def _write(path, content):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+#------------------------------------------------------------------------------
+# Apply a new config: SIGHUP if dnsmasq can reload it, restart otherwise.
+def apply(dns_config):
+    global _current
+    prepare(dns_config)
+    if is_running() and not dns_config.needs_restart(_current):
+        logger.info('Reloading dnsmasq, PID=%s', _process.pid)
+        _process.send_signal(signal.SIGHUP)
+    else:
+        _restart()
+    _current = dns_config
+
+
+def is_running():
+    return _process is not None and _process.poll() is None
+
+
+#------------------------------------------------------------------------------
+# Stop our dnsmasq, or one left over from a previous run.
 def stop():
-    ps = subprocess.Popen("ps -e | grep ' dnsmasq' | cut -c 1-6", shell=True, stdout=subprocess.PIPE)
-    pid = ps.stdout.read()
-    ps.stdout.close()
-    ps.wait()
-    pid = pid.decode('utf-8')
-    pid = pid.strip()
-    if 0 < len(pid):
-        print("Killing dnsmasq, PID='{}'".format(pid))
-        ps = subprocess.Popen("kill -9 {pid}", shell=True)
-        ps.wait()
-
-
-def start():
-    # first kill any existing dnsmasq
+    global _process, _current
+    paths = get_paths()
+    if _process is not None:
+        pid = _process.pid
+        if _process.poll() is None:
+            logger.info('Stopping dnsmasq, PID=%s', pid)
+            _process.terminate()
+            try:
+                _process.wait(timeout=STOP_WAIT_SECS)
+            except subprocess.TimeoutExpired:
+                _process.kill()
+                _process.wait()
+        _process = None
+    else:
+        _stop_stray(paths['pid'])
+    _current = None
+    try:
+        os.remove(paths['pid'])
+    except OSError:
+        pass
+
+
+# The pid file outlives a crash or a container kill, and after a reboot its
+# PID may belong to anything, us included.  Only signal it if it's still a
+# dnsmasq, and wait for it to let go of its ports.
+def _stop_stray(pid_path):
+    try:
+        with open(pid_path) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return
+    if pid == os.getpid() or not _is_dnsmasq(pid):
+        return
+    logger.info('Stopping dnsmasq left from a previous run, PID=%s', pid)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            return
+        deadline = time.monotonic() + STOP_WAIT_SECS
+        while time.monotonic() < deadline:
+            if not _is_dnsmasq(pid):
+                return
+            time.sleep(0.1)
+    logger.warning('dnsmasq PID=%s did not exit.', pid)
+
+
+# A live (not zombie) process named dnsmasq.
+def _is_dnsmasq(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return False
+    name, rest = stat[stat.find('(') + 1:].rsplit(')', 1)
+    return name == 'dnsmasq' and rest.split()[0] != 'Z'
+
+
+#------------------------------------------------------------------------------
+# dns_config can be prepared ahead of time with build_config().
+def start(interface=None, dns_config=None):
+    if dns_config is None:
+        dns_config = build_config(interface)
+    apply(dns_config)
+
+
+def _restart():
+    global _process
+    # first stop any existing dnsmasq
     stop()
 
-    # build the list of args
-    args = ["dnsmasq"]
-    args.append("--listen-address=/#/{DEFAULT_GATEWAY}")
-    args.append("--dhcp-range={DEFAULT_DHCP_RANGE}")
-    args.append("--dhcp-option=option:router,{DEFAULT_GATEWAY}")
-    args.append("--interface={DEFAULT_INTERFACE}")
-    args.append("--keep-in-foreground")
-    args.append("--bind-interfaces")
-    args.append("--except-interface=lo")
-    args.append("--dhcp-authoritative")
-    args.append("--no-hosts" )
+    paths = get_paths()
+    args = ["dnsmasq",
+            "--conf-file={}".format(paths['conf']),
+            "--keep-in-foreground"]
 
     # run dnsmasq in the background and save a reference to the object
-    ps = subprocess.Popen(args)
-    # don't wait here, proc runs in background until we kill it.
+    _process = subprocess.Popen(args)
+    # don't wait here, proc runs in background until we stop it.
+    with open(paths['pid'], 'w') as f:
+        f.write(str(_process.pid))
 
-    # give a few seconds for the proc to start
-    time.sleep(2)
-    print('Started dnsmasq, PID={}'.format(ps.pid))
+    # dnsmasq exits straight away on a bad config, otherwise it's up.
+    try:
+        _process.wait(timeout=0.5)
+        logger.error('dnsmasq exited on start, code=%s', _process.returncode)
+        _process = None
+    except subprocess.TimeoutExpired:
+        logger.info('Started dnsmasq, PID=%s', _process.pid)
@@ -0,0 +1,101 @@
+# Server-Sent Events for the portal UI.
+#
+# The HTTP handler sends the SSE response headers and hands the socket over
+# to an EventHub, which keeps it open and writes events to every client from
+# a single thread.  So an open portal page costs us a socket, not a request
+# handler, and a published event is encoded once no matter how many pages
+# are listening.
+
+import json, queue, socket, threading
+
+import netman
+
+HEARTBEAT_SECS = 15 # keeps proxies / phones from closing an idle stream
+SEND_TIMEOUT_SECS = 2 # clients that can't take an event in this long are dropped
+
+
+#------------------------------------------------------------------------------
+# Encode one SSE message.
+def encode(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event,
+            json.dumps(data, default=netman.to_json)).encode('utf-8')
+
+
+#------------------------------------------------------------------------------
+# The set of connected SSE clients and the thread that writes to them.
+class EventHub(object):
+
+    def __init__(self, heartbeat=HEARTBEAT_SECS):
+        self.heartbeat = heartbeat
+        self._clients = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Take over a socket whose response headers have been sent.  initial is
+    # a list of (event, data) only this client gets, e.g. the current state.
+    def attach(self, sock, initial=()):
+        sock.settimeout(SEND_TIMEOUT_SECS)
+        payload = b''.join(encode(event, data) for event, data in initial)
+        self._queue.put(('attach', sock, payload))
+
+    # Send an event to every client.
+    def publish(self, event, data):
+        self._queue.put(('publish', None, encode(event, data)))
+
+    def client_count(self):
+        return len(self._clients)
+
+    # Disconnect everyone and stop the thread.
+    def close(self):
+        self._queue.put(('close', None, None))
+        self._thread.join(SEND_TIMEOUT_SECS * 2)
+
+    def _run(self):
+        while True:
+            try:
+                action, sock, payload = self._queue.get(timeout=self.heartbeat)
+            except queue.Empty:
+                action, sock, payload = 'publish', None, b': ping\n\n'
+
+            if action == 'close':
+                for client in self._clients:
+                    self._drop(client)
+                self._clients = []
+                return
+
+            if action == 'attach':
+                if not payload or self._send(sock, payload):
+                    self._clients.append(sock)
+                continue
+
+            self._clients = [c for c in self._clients if self._send(c, payload)]
+
+    # Returns False (and closes the socket) if the client is gone.
+    def _send(self, sock, payload):
+        try:
+            sock.sendall(payload)
+            return True
+        except (OSError, socket.timeout):
+            self._drop(sock)
+            return False
+
+    def _drop(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+
+#------------------------------------------------------------------------------
+# What changed between two lists of netman.AccessPoint, as sent in the
+# 'networks-diff' event.
+def diff_networks(old, new):
+    old_keys = set((ap.ssid, ap.security) for ap in old)
+    new_keys = set((ap.ssid, ap.security) for ap in new)
+    return {
+        'added': [ap for ap in new if (ap.ssid, ap.security) not in old_keys],
+        'removed': [ap for ap in old if (ap.ssid, ap.security) not in new_keys],
+    }
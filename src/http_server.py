@@ -1,85 +1,311 @@
 # Our main wifi-connect application, which is based around an HTTP server.
 
-import os, getopt, sys, json, atexit, time
+import sys
+
+# Start timing imports before we import anything else.
+if '--profile-startup' in sys.argv:
+    import profiling
+    profiling.start()
+if '--profile-memory' in sys.argv:
+    import memprof
+    memprof.start()
+
+import os, getopt, json, atexit, time, threading, mimetypes, socket, hmac, math
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import parse_qs
-from io import BytesIO
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
 
 # Local modules
+import config
 import netman
 import dnsmasq
+import events
+import log
+import memprof
+import portal
+import profiling
+import sampler
+import scanner
+import scheduler
+import startup
+import supervisor
+
+logger = log.get('http_server')
 
 # Defaults
-ADDRESS = os.getenv('DEFAULT_GATEWAY', netman.bln_device_fetch())
 PORT = 80
+SCAN_WAIT_SECS = 15 # longest a refresh waits for a scan someone else started
 UI_PATH = '../ui'
 
 
 #------------------------------------------------------------------------------
 # called at exit
 def cleanup():
-    print("Cleaning up prior to exit.")
+    logger.info('Cleaning up prior to exit.')
     dnsmasq.stop()
-    if not int(os.getenv('DISABLE_HOTSPOT', 0)):
+    if not config.get().disable_hotspot:
         netman.stop_hotspot()
 
 
+#------------------------------------------------------------------------------
+# Read every file under the UI directory into memory so the portal can be
+# served without touching the SD card, and kept warm between daemon cycles.
+# Returns a dict of URL path -> (content type, bytes).
+def load_ui_cache(web_dir):
+    cache = {}
+    for root, dirs, files in os.walk(web_dir):
+        for name in files:
+            full_path = os.path.join(root, name)
+            url_path = '/' + os.path.relpath(full_path, web_dir).replace(os.sep, '/')
+            ctype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            with open(full_path, 'rb') as f:
+                cache[url_path] = (ctype, f.read())
+    if '/index.html' in cache:
+        cache['/'] = cache['/index.html']
+    logger.info('Cached %d UI files.', len(cache))
+    return cache
+
+
 #------------------------------------------------------------------------------
 # A custom http server class in which we can set the default path it serves
 # when it gets a GET request.
-class MyHTTPServer(HTTPServer):
+# It also holds the list of SSIDs we serve, shared by all requests.
+# Each connection gets a thread, so a kept-alive connection sitting idle
+# doesn't hold up everyone else.
+class MyHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
     def __init__(self, base_path, server_address, RequestHandlerClass):
         self.base_path = base_path
+        self.connected = False # set by the handler when the user's AP is up
+        self.ssids = []
+        self.networks_json = b'[]'
+        self.networks_version = 0 # bumped on every set_networks()
+        self.page_cache = portal.PageCache()
+        self.events = events.EventHub() # SSE clients of the portal page
+        self.detached = set() # sockets handed over to self.events
+        cfg = config.get()
+        self.scheduler = scheduler.ConnectScheduler(self.connect,
+                rate=1.0 / cfg.connect_interval, burst=cfg.connect_burst,
+                max_queue=cfg.connect_queue)
+        self.scanner = scanner.Scanner(self.rescan, cfg.scan_min_interval,
+                self.can_scan)
+        self._can_scan = None
         HTTPServer.__init__(self, server_address, RequestHandlerClass)
 
+    # Let us bind the gateway address before the hotspot has brought it up,
+    # so the socket can be ready while NetworkManager is still working.
+    def server_bind(self):
+        try:
+            self.socket.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
+        except (AttributeError, OSError) as e:
+            logger.warning('Unable to set IP_FREEBIND: %s', e)
+        HTTPServer.server_bind(self)
+
+    # Update the SSIDs and the /networks response we send for them, and tell
+    # the open portal pages what changed.
+    def set_networks(self, ssids):
+        diff = events.diff_networks(self.ssids, ssids)
+        self.networks_json = json.dumps(ssids,
+                default=netman.to_json).encode('utf-8')
+        self.ssids = ssids
+        self.networks_version += 1
+        if diff['added'] or diff['removed']:
+            self.events.publish('networks-diff', diff)
+
+    # Scan for the scanner, and tell the open pages what changed.
+    def rescan(self):
+        ssids = netman.rescan()
+        if ssids is not None:
+            self.set_networks(ssids)
+        return ssids
+
+    # Whether the scanner may scan while the portal is up.  On a single
+    # radio unit the radio is running our hotspot, and a scan in AP mode
+    # only finds the hotspot itself.
+    def can_scan(self):
+        if self._can_scan is None:
+            self._can_scan = config.get().disable_hotspot or \
+                    netman.is_dual_interface()
+        return self._can_scan
+
+    # Stop serving.  shutdown() waits for serve_forever(), so when called
+    # from a request handler it has to come from another thread.
+    def close_portal(self, connected):
+        self.connected = connected
+        threading.Thread(target=self.shutdown).start()
+
+    # Tell the open portal pages how a connection attempt is going.
+    def publish_connect_phase(self, phase, ssid):
+        self.events.publish('connect', {'phase': phase, 'ssid': ssid})
+
+    # Don't close the sockets of SSE clients, the event hub owns them now.
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        HTTPServer.shutdown_request(self, request)
+
+    # Run one connection attempt from the scheduler, returns True if we
+    # connected (and are closing the portal).
+    def connect(self, job):
+        ssid = job.ssid
+
+        # With two radios the hotspot stays up while we test the new
+        # connection, so the user keeps the portal if it fails.
+        pair = netman.get_device_pair()
+        dual_interface = netman.is_dual_interface(pair)
+
+        if not config.get().disable_hotspot and not dual_interface:
+            # Stop the hotspot
+            self.publish_connect_phase('stopping-hotspot', ssid)
+            netman.stop_hotspot()
+
+        # Connect to the user's selected AP
+        self.publish_connect_phase('connecting', ssid)
+        success = netman.connect_to_AP(conn_type=job.conn_type, ssid=ssid, \
+                username=job.username, password=job.password, pair=pair)
+        self.publish_connect_phase('connected' if success else 'failed', ssid)
+
+        if success and dual_interface and not config.get().disable_hotspot:
+            netman.stop_hotspot()
+
+        # Handle success or failure of the new connection
+        if success:
+            logger.info('Connected!  Closing the portal.')
+            self.close_portal(True)
+        else:
+            logger.warning('Connection failed, restarting the hotspot.')
+            # Update the list of SSIDs since we are not connected
+            self.set_networks(netman.get_list_of_access_points())
+            self.scanner.seed(self.ssids)
+            memprof.mark('rescan')
+            # Start the hotspot again (it is still up with two radios)
+            if not dual_interface:
+                self.publish_connect_phase('restarting-hotspot', ssid)
+                netman.start_hotspot()
+            self.publish_connect_phase('ready', ssid)
+        return success
+
+    def server_close(self):
+        self.scheduler.close()
+        self.events.close()
+        HTTPServer.server_close(self)
+
+
+# Linux socket option, not exported by the socket module on python3.6.
+IP_FREEBIND = getattr(socket, 'IP_FREEBIND', 15)
+
 
 #------------------------------------------------------------------------------
 # A custom http request handler class factory.
 # Handle the GET and POST requests from the UI form and JS.
 # The class factory allows us to pass custom arguments to the handler.
-def RequestHandlerClassFactory(address, ssids, rcode):
+def RequestHandlerClassFactory(address, rcode, ui_cache=None):
 
     class MyHTTPReqHandler(SimpleHTTPRequestHandler):
 
+        # Keep connections open between requests (every response must have
+        # a Content-Length), and close them after this many idle seconds.
+        protocol_version = 'HTTP/1.1'
+        timeout = config.get().keepalive_timeout
+
         def __init__(self, *args, **kwargs):
             # We must set our custom class properties first, since __init__() of
             # our super class will call do_GET().
             self.address = address
-            self.ssids = ssids
             self.rcode = rcode
+            self.ui_cache = ui_cache or {}
             super(MyHTTPReqHandler, self).__init__(*args, **kwargs)
 
+        # The request log goes through our logger instead of straight to
+        # stderr.
+        def log_message(self, format, *args):
+            if logger.isEnabledFor(log.INFO):
+                logger.info('%s ' + format, self.address_string(), *args)
+
+        # Send a complete response with its Content-Length.
+        def send_body(self, code, content, ctype='text/plain; charset=utf-8', \
+                headers=()):
+            self.send_response(code)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(content)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        # Static files not served from memory go straight from the file to
+        # the socket with sendfile(), instead of being copied through python.
+        def copyfile(self, source, outputfile):
+            if outputfile is not self.wfile:
+                return super().copyfile(source, outputfile)
+            self.wfile.flush()
+            try:
+                self.connection.sendfile(source)
+            except (AttributeError, OSError, ValueError):
+                super().copyfile(source, outputfile)
+
+        # The /admin/ endpoints need ADMIN_TOKEN, in an X-Admin-Token header
+        # or a token query parameter.  They don't exist without it.
+        def is_admin(self):
+            token = config.get().admin_token
+            if not token:
+                return False
+            query = parse_qs(urlsplit(self.path).query)
+            given = self.headers.get('X-Admin-Token') or \
+                    query.get('token', [''])[0]
+            return hmac.compare_digest(given.encode('utf-8'),
+                    token.encode('utf-8'))
+
+        def do_admin(self, path):
+            if not self.is_admin():
+                self.send_error(404)
+                return
+
+            # Memory use per phase, and the top allocation sites when
+            # started with --profile-memory.
+            if '/admin/memory' == path:
+                self.send_body(200, json.dumps(memprof.report()).encode('utf-8'),
+                        'application/json')
+                return
+
+            # Signal stats of the AP we're connected to, and the raw samples.
+            signal = sampler.get()
+            if '/admin/signal' == path and signal is not None:
+                self.send_body(200, json.dumps(signal.report()).encode('utf-8'),
+                        'application/json')
+                return
+            if '/admin/signal.bin' == path and signal is not None:
+                self.send_body(200, signal.buffer.dump(),
+                        'application/octet-stream')
+                return
+
+            self.send_error(404)
+
         # See if this is a specific request, otherwise let the server handle it.
         def do_GET(self):
 
-            print('do_GET {}'.format(self.path))
+            logger.debug('do_GET %s', self.path)
 
             # Handle the hotspot starting and a computer connecting to it,
             # we have to return a redirect to the gateway to get the
             # captured portal to show up.
             if '/hotspot-detect.html' == self.path:
-                self.send_response(301) # redirect
                 new_path = 'http://{}/'.format(self.address)
-                print('redirecting to {}'.format(new_path))
-                self.send_header('Location', new_path)
-                self.end_headers()
+                logger.debug('redirecting to %s', new_path)
+                self.send_body(301, b'', headers=[('Location', new_path)])
+                return
 
             # Handle a REST API request to return the device registration code
             if '/regcode' == self.path:
-                self.send_response(200)
-                self.end_headers()
-                response = BytesIO()
-                response.write(self.rcode.encode('utf-8'))
-                print('GET {self.path} returning: {response.getvalue()}')
-                self.wfile.write(response.getvalue())
+                response = self.rcode.encode('utf-8')
+                logger.debug('GET %s returning: %r', self.path, response)
+                self.send_body(200, response)
                 return
 
             # Handle a REST API request to return the list of SSIDs
             if '/networks' == self.path:
-                self.send_response(200)
-                self.end_headers()
-                response = BytesIO()
-                ssids = self.ssids # passed in to the class factory
                 """ map whatever we get from net man to our constants:
                 Security:
                     NONE
@@ -93,15 +319,55 @@ def RequestHandlerClassFactory(address, ssids, rcode):
                     HIDDEN, WEP, WPA, WPA2 - Need password.
                     ENTERPRISE             - Need username and password.
                 """
-                response.write(json.dumps(ssids).encode('utf-8'))
-                print('GET {self.path} returning: {response.getvalue()}')
-                self.wfile.write(response.getvalue())
+                # serialized once, when the list changes
+                response = self.server.networks_json
+                logger.debug('GET %s returning %d bytes', self.path,
+                        len(response))
+                self.send_body(200, response, 'application/json')
+                return
+
+            # Server-Sent Events: the current network list, then changes to
+            # it and the progress of connection attempts.
+            if '/events' == self.path:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.wfile.flush()
+                self.close_connection = True
+                self.server.detached.add(self.connection)
+                self.server.events.attach(self.connection,
+                        [('networks', self.server.ssids)])
                 return
 
             # Not sure if this is just OSX hitting the captured portal,
             # but we need to exit if we get it.
             if '/bag' == self.path:
-                sys.exit()
+                self.send_body(200, b'')
+                self.server.close_portal(False)
+                return
+
+            path = self.path.split('?', 1)[0].split('#', 1)[0]
+
+            if path.startswith('/admin/'):
+                self.do_admin(path)
+                return
+
+            # Serve the UI from memory if we have it.
+
+            # The portal page, with the networks and reg code rendered in.
+            if path in ('/', '/index.html') and '/index.html' in self.ui_cache:
+                content = self.server.page_cache.get(self.ui_cache,
+                        self.server.ssids, self.server.networks_version,
+                        self.rcode)
+                self.send_body(200, content, 'text/html; charset=utf-8',
+                        [('Cache-Control', 'no-cache')])
+                return
+
+            if path in self.ui_cache:
+                ctype, content = self.ui_cache[path]
+                self.send_body(200, content, ctype)
+                return
 
             # All other requests are handled by the server which vends files
             # from the ui_path we were initialized with.
@@ -110,11 +376,17 @@ def RequestHandlerClassFactory(address, ssids, rcode):
 
         # test with: curl localhost:5000 -d "{'name':'value'}"
         def do_POST(self):
-            content_length = int(self.headers['Content-Length'])
+            content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            self.send_response(200)
-            self.end_headers()
-            response = BytesIO()
+
+            # Rescan the networks, or join the scan that's running.
+            if '/networks/refresh' == self.path:
+                result = self.server.scanner.refresh(SCAN_WAIT_SECS)
+                self.send_body(200, json.dumps(result,
+                        default=netman.to_json).encode('utf-8'),
+                        'application/json')
+                return
+
             fields = parse_qs(body.decode('utf-8'))
             #print('POST received: {}'.format(fields))
 
@@ -125,7 +397,8 @@ def RequestHandlerClassFactory(address, ssids, rcode):
             FORM_PASSWORD = 'passphrase'
 
             if FORM_SSID not in fields:
-                print('Error: POST is missing {} field.'.format(FORM_SSID))
+                logger.warning('Error: POST is missing %s field.', FORM_SSID)
+                self.send_body(400, b'ERROR\n')
                 return
 
             ssid = fields[FORM_SSID][0]
@@ -145,98 +418,175 @@ def RequestHandlerClassFactory(address, ssids, rcode):
             if FORM_HIDDEN_SSID in fields:
                 conn_type = netman.CONN_TYPE_SEC_PASSWORD # Assumption...
 
-            for s in self.ssids:
-                if FORM_SSID in s and ssid == s[FORM_SSID]:
-                    if s['security'] == "ENTERPRISE":
+            for ap in self.server.ssids:
+                if ssid == ap.ssid:
+                    if ap.security == "ENTERPRISE":
                         conn_type = netman.CONN_TYPE_SEC_ENTERPRISE
-                    elif s['security'] == "NONE":
+                    elif ap.security == "NONE":
                         conn_type = netman.CONN_TYPE_SEC_NONE
                     else:
                         # all others need a password
                         conn_type = netman.CONN_TYPE_SEC_PASSWORD
                     break
 
-            if not int(os.getenv('DISABLE_HOTSPOT', 0)):
-                # Stop the hotspot
-                netman.stop_hotspot()
-
-            # Connect to the user's selected AP
-            success = netman.connect_to_AP(conn_type=conn_type, ssid=ssid, \
-                    username=username, password=password)
-
-            if success:
-                response.write(b'OK\n')
-            else:
-                response.write(b'ERROR\n')
-            self.wfile.write(response.getvalue())
-
-            # Handle success or failure of the new connection
-            if success:
-                print('Connected!  Exiting app.')
-                sys.exit()
-            else:
-                print('Connection failed, restarting the hotspot.')
-                # Update the list of SSIDs since we are not connected
-                self.ssids = netman.get_list_of_access_points()
-                # Start the hotspot again
-                netman.start_hotspot()
+            job = scheduler.ConnectJob(self.client_address[0], ssid,
+                    conn_type, username, password)
+            status, job, retry_after = self.server.scheduler.submit(job)
+            response = {'status': status, 'ssid': ssid}
+            headers = []
+
+            if job is not None:
+                # Accepted, the outcome comes as 'connect' events.
+                code = 202
+                response['position'] = 0 if status == scheduler.STARTED \
+                        else self.server.scheduler.position(job)
+                if status == scheduler.QUEUED:
+                    self.server.publish_connect_phase('queued', ssid)
+            elif status == scheduler.RATE_LIMITED:
+                code = 429
+                retry_after = int(math.ceil(retry_after))
+                response['retry_after'] = retry_after
+                headers.append(('Retry-After', str(retry_after)))
+            else: # busy, or closing
+                code = 503
+
+            logger.info('POST %s for %s: %s', self.path, ssid, status)
+            self.send_body(code, json.dumps(response).encode('utf-8'),
+                    'application/json', headers)
 
     return  MyHTTPReqHandler # the class our factory just created.
 
 
 #------------------------------------------------------------------------------
-# Create the hotspot, start dnsmasq, start the HTTP server.
-def main(address, port, ui_path, rcode, delete_connections):
-
-    # See if caller wants to delete all existing connections first
-    if delete_connections:
-        netman.delete_all_wifi_connections()
-
-    # Check if we are already connected, if so we are done.
-    while netman.have_active_internet_connection():
-        print('Already connected to the internet, next check in 10s...')
-        time.sleep(10)
+# Create the hotspot, start dnsmasq, serve the portal until the user's AP is
+# connected.  Returns True if we connected, False if the portal was closed
+# for another reason.
+# ui_cache is a dict the UI gets loaded into, if it's empty.
+def run_portal(address, port, web_dir, rcode, ui_cache):
+    hotspot = not config.get().disable_hotspot
 
     # Get list of available AP from net man.
     # Must do this AFTER deleting any existing connections (above),
     # and BEFORE starting our hotspot (or the hotspot will be the only thing
     # in the list).
-    ssids = netman.get_list_of_access_points()
+    def scan(deps):
+        return netman.get_list_of_access_points()
 
-    if not int(os.getenv('DISABLE_HOTSPOT', 0)):
-        # Start the hotspot
-        if not netman.start_hotspot():
-            print('Error starting hotspot, exiting.')
+    def start_hotspot(deps):
+        if hotspot and not netman.start_hotspot():
+            logger.error('Error starting hotspot, exiting.')
             sys.exit(1)
-        # Start dnsmasq (to advertise us as a router so captured portal pops up
-        # on the users machine to vend our UI in our http server)
-        dnsmasq.start()
 
-    # Find the ui directory which is up one from where this file is located.
-    web_dir = os.path.join(os.path.dirname(__file__), ui_path)
-    print('HTTP serving directory: {} on {}:{}'.format(web_dir, address, port))
+    def dnsmasq_config(deps):
+        dns_config = dnsmasq.build_config(netman.get_ap_interface())
+        if hotspot:
+            dnsmasq.prepare(dns_config)
+        return dns_config
 
-    # Change to this directory so the HTTPServer returns the index.html in it
-    # by default when it gets a GET.
-    os.chdir(web_dir)
+    # Start dnsmasq (to advertise us as a router so captured portal pops up
+    # on the users machine to vend our UI in our http server)
+    def start_dnsmasq(deps):
+        if hotspot:
+            dnsmasq.start(dns_config=deps['dnsmasq_config'])
 
-    # Host:Port our HTTP server listens on
-    server_address = (address, port)
+    # Start an HTTP server to serve the content in the ui dir and handle the
+    # POST request in the handler class.  The handler class is set below,
+    # nothing is served until serve_forever().
+    def bind(deps):
+        return MyHTTPServer(web_dir, (address, port), None)
+
+    def load_ui(deps):
+        if not ui_cache:
+            ui_cache.update(load_ui_cache(web_dir))
+
+    def networks(deps):
+        deps['bind'].set_networks(deps['scan'])
+        deps['bind'].scanner.seed(deps['scan'])
+
+    results = startup.run([
+        startup.Step('scan', scan),
+        startup.Step('start_hotspot', start_hotspot, ['scan']),
+        startup.Step('dnsmasq_config', dnsmasq_config),
+        startup.Step('dnsmasq', start_dnsmasq,
+                ['start_hotspot', 'dnsmasq_config']),
+        startup.Step('bind', bind),
+        startup.Step('load_ui', load_ui),
+        startup.Step('networks', networks, ['bind', 'scan']),
+    ])
+    httpd = results['bind']
+    memprof.mark('startup')
+    if memprof.tracing():
+        memprof.print_report()
 
     # Custom request handler class (so we can pass in our own args)
-    MyRequestHandlerClass = RequestHandlerClassFactory(address, ssids, rcode)
+    httpd.RequestHandlerClass = RequestHandlerClassFactory(address, rcode,
+            ui_cache)
 
-    # Start an HTTP server to serve the content in the ui dir and handle the
-    # POST request in the handler class.
-    print('Waiting for a connection to our hotspot {} ...'.format(netman.get_hotspot_SSID()))
-    httpd = MyHTTPServer(web_dir, server_address, MyRequestHandlerClass)
+    logger.info('Waiting for a connection to our hotspot %s ...',
+            netman.get_hotspot_SSID())
+    profiling.report()
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         dnsmasq.stop()
         netman.stop_hotspot()
+        raise
+    finally:
         httpd.server_close()
 
+    # The hotspot is already gone, we only need to stop advertising it.
+    dnsmasq.stop()
+    return httpd.connected
+
+
+#------------------------------------------------------------------------------
+# Serve the portal when we are offline.  In daemon mode, keep watching the
+# uplink after connecting and bring the portal back when it drops.
+def main(address, port, ui_path, rcode, delete_connections, daemon=False, \
+        grace_period=30):
+
+    # See if caller wants to delete all existing connections first
+    if delete_connections:
+        with profiling.phase('delete_connections'):
+            netman.delete_all_wifi_connections()
+
+    # Find the ui directory which is up one from where this file is located.
+    web_dir = os.path.join(os.path.dirname(__file__), ui_path)
+    logger.info('HTTP serving directory: %s on %s:%s', web_dir, address, port)
+
+    # Change to this directory so the HTTPServer returns the index.html in it
+    # by default when it gets a GET.
+    os.chdir(web_dir)
+    # Loaded during the first startup, kept for the next daemon cycle.
+    ui_cache = {}
+
+    # Keeps a signal history of our client connection, for /admin/signal.
+    sampler.start()
+
+    # At boot, let NetworkManager finish connecting to a saved network
+    # before we decide we're offline and take the radio for the hotspot.
+    with profiling.phase('wait_for_autoconnect'):
+        netman.wait_for_autoconnect(config.get().autoconnect_wait)
+
+    # Check if we are already connected, if so we are done.
+    while netman.have_active_internet_connection():
+        if daemon:
+            netman.wait_for_uplink_loss(grace_period)
+            break
+        logger.info('Already connected to the internet, next check in 10s...')
+        time.sleep(10)
+
+    try:
+        while True:
+            connected = run_portal(address, port, web_dir, rcode, ui_cache)
+            if not daemon or not connected:
+                break
+            logger.info('Watching the uplink, portal returns after %ss '
+                    'offline.', grace_period)
+            netman.wait_for_uplink_loss(grace_period)
+    except KeyboardInterrupt:
+        pass
+
 
 #------------------------------------------------------------------------------
 # Util to convert a string to an int, or provide a default.
@@ -252,11 +602,17 @@ def string_to_int(s, default):
 if __name__ == "__main__":
     atexit.register(cleanup)
 
-    address = ADDRESS
+    cfg = config.get()
+    # Ask the balena supervisor about us while we parse the args, the
+    # gateway lookup below may need it.
+    supervisor.prefetch()
+    address = None # the gateway, only looked up if -a is not given
     port = PORT
     ui_path = UI_PATH
     delete_connections = False
     rcode = ''
+    daemon = cfg.daemon
+    grace_period = cfg.grace_period
 
     usage = ''\
 'Command line args: \n'\
@@ -265,10 +621,15 @@ if __name__ == "__main__":
 '  -u <UI directory to serve>   Default: "{ui_path}" \n'\
 '  -d Delete Connections First  Default: {delete_connections} \n'\
 '  -r Device Registration Code  Default: "" \n'\
+'  -D Daemon mode, stay resident Default: {daemon} \n'\
+'  -g <Portal grace period secs> Default: {grace_period} \n'\
+'  --profile-startup            Print import and startup timings \n'\
+'  --profile-memory             Trace memory use, see /admin/memory \n'\
 '  -h Show help.\n'
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "a:p:u:r:dh")
+        opts, args = getopt.getopt(sys.argv[1:], "a:p:u:r:g:dDh",
+                ["profile-startup", "profile-memory"])
     except getopt.GetoptError:
         print(usage)
         sys.exit(2)
@@ -293,9 +654,21 @@ if __name__ == "__main__":
         elif opt in ("-u"):
             ui_path = arg
 
-    print('Address={}'.format(address))
-    print('Port={}'.format(port))
-    print('UI path={}'.format(ui_path))
-    print('Device registration code={}'.format(rcode))
-    print('Delete Connections={}'.format(delete_connections))
-    main(address, port, ui_path, rcode, delete_connections)
+        elif opt in ("-D"):
+            daemon = True
+
+        elif opt in ("-g"):
+            grace_period = string_to_int(arg, grace_period)
+
+    if address is None:
+        address = cfg.gateway
+
+    logger.info('Address=%s', address)
+    logger.info('Port=%s', port)
+    logger.info('UI path=%s', ui_path)
+    logger.info('Device registration code=%s', rcode)
+    logger.info('Delete Connections=%s', delete_connections)
+    logger.info('Daemon=%s grace period=%ss', daemon, grace_period)
+    memprof.mark('imports')
+    main(address, port, ui_path, rcode, delete_connections, daemon,
+            grace_period)
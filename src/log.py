@@ -0,0 +1,149 @@
+# Logging for the application.
+#
+# Log calls only put the record on a bounded queue, a background thread
+# formats it and writes it out.  On balena stdout is a pipe to the
+# supervisor that can block for a while, and a request handler shouldn't
+# wait on it.  If the writer falls that far behind, new records are dropped
+# (and counted) rather than blocking the caller.
+#
+# Use get(__name__) and the usual logging calls with %-style arguments, so
+# a line below the configured level costs only the level check:
+#
+#     logger = log.get(__name__)
+#     logger.debug('GET %s returning %d bytes', path, len(body))
+#
+# LOG_LEVEL sets the level (default INFO), LOG_FORMAT=json writes one JSON
+# object per line, with any extra={...} fields included.
+
+import atexit, json, logging, logging.handlers, queue, sys, threading, time
+
+from logging import DEBUG, INFO, WARNING, ERROR
+
+import config
+
+ROOT = 'wifi-connect'
+TEXT_FORMAT = '%(levelname)s %(name)s: %(message)s'
+
+# Attributes every LogRecord has, anything else came from extra={...}.
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+_RECORD_ATTRS |= frozenset(('message', 'asctime'))
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+
+
+#------------------------------------------------------------------------------
+# One JSON object per line: time, level, logger, msg, the extra fields and
+# the exception if there is one.
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+#------------------------------------------------------------------------------
+# Puts records on the queue without blocking, counting what doesn't fit.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, q):
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1 # not locked, an approximate count is fine
+
+    # The stdlib version formats the message here, on the caller's thread.
+    # We leave that to the writer thread, so don't log objects you are about
+    # to change.
+    def prepare(self, record):
+        return record
+
+
+#------------------------------------------------------------------------------
+# Writes the queued records, and says so when some were dropped.
+class _Listener(logging.handlers.QueueListener):
+
+    def __init__(self, q, source, *handlers):
+        logging.handlers.QueueListener.__init__(self, q, *handlers)
+        self.source = source
+        self.reported = 0
+
+    # Block for the stop sentinel, a full queue drains.
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        logging.handlers.QueueListener.handle(self, record)
+        dropped = self.source.dropped
+        if dropped != self.reported and self.queue.empty():
+            logging.handlers.QueueListener.handle(self, logging.makeLogRecord({
+                'name': ROOT + '.log', 'levelno': logging.WARNING,
+                'levelname': 'WARNING', 'created': time.time(),
+                'msg': 'Dropped %d log records, the output is too slow.',
+                'args': (dropped - self.reported,),
+                'dropped': dropped}))
+            self.reported = dropped
+
+
+#------------------------------------------------------------------------------
+# Configure our loggers from config, once.  get() calls this.
+def setup(stream=None):
+    global _listener, _handler
+    with _lock:
+        if _listener is not None:
+            return
+        cfg = config.get()
+
+        out = logging.StreamHandler(stream or sys.stdout)
+        if cfg.log_format == 'json':
+            out.setFormatter(JsonFormatter())
+        else:
+            out.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        _handler = DroppingQueueHandler(queue.Queue(cfg.log_queue_size))
+        root = logging.getLogger(ROOT)
+        root.setLevel(cfg.log_level)
+        root.addHandler(_handler)
+        root.propagate = False
+
+        _listener = _Listener(_handler.queue, _handler, out)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+# Write out what's queued and stop the writer thread.
+def shutdown():
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+        logging.getLogger(ROOT).removeHandler(_handler)
+
+
+# The number of records dropped so far because the queue was full.
+def dropped():
+    return _handler.dropped if _handler else 0
+
+
+#------------------------------------------------------------------------------
+# Return the logger for a module, e.g. get(__name__).
+def get(name):
+    setup()
+    return logging.getLogger('{}.{}'.format(ROOT, name))
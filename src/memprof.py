@@ -0,0 +1,97 @@
+# Memory instrumentation for small (Pi Zero class) devices.
+#
+# mark(phase) records the resident set size (current and peak) at the end
+# of each phase.  With start() (the --profile-memory flag) tracemalloc is
+# also on, and the report includes the python heap per phase and the top
+# allocation sites.  tracemalloc costs memory and CPU, so it's opt-in.
+
+import os, resource, sys, threading, time, tracemalloc
+
+_lock = threading.Lock()
+_phases = [] # dicts, see mark()
+MAX_PHASES = 100 # the daemon marks phases forever, keep the last ones
+
+
+#------------------------------------------------------------------------------
+# Start tracing python allocations, keeping frames deep tracebacks.
+# Must be called early to see the allocations made at import time.
+def start(frames=1):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def tracing():
+    return tracemalloc.is_tracing()
+
+
+#------------------------------------------------------------------------------
+# Current resident set size in bytes, from /proc (Linux only), or None.
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Peak resident set size in bytes (ru_maxrss is in KiB on Linux).
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+#------------------------------------------------------------------------------
+# Record the memory use at the end of a phase (e.g. 'startup', 'scan').
+def mark(phase):
+    entry = {'phase': phase, 'time': time.time(),
+             'rss': current_rss(), 'peak_rss': peak_rss()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        entry['traced'] = current
+        entry['traced_peak'] = peak
+        # peak per phase, not since start (python3.9+)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+    with _lock:
+        _phases.append(entry)
+        del _phases[:-MAX_PHASES]
+
+
+#------------------------------------------------------------------------------
+# The report as a dict (for the admin endpoint).
+def report(limit=10):
+    with _lock:
+        phases = list(_phases)
+    result = {'rss': current_rss(), 'peak_rss': peak_rss(),
+              'tracing': tracemalloc.is_tracing(), 'phases': phases}
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')])
+        result['top'] = [{'site': str(stat.traceback), 'size': stat.size,
+                          'count': stat.count}
+                         for stat in snapshot.statistics('lineno')[:limit]]
+    return result
+
+
+#------------------------------------------------------------------------------
+# Print the report, for the --profile-memory flag.
+def print_report(limit=10, out=None):
+    out = out or sys.stderr
+    data = report(limit)
+
+    def kib(n):
+        return '-' if n is None else '{:.0f}'.format(n / 1024.0)
+
+    print('Memory: rss {} KiB, peak rss {} KiB'.format(kib(data['rss']),
+            kib(data['peak_rss'])), file=out)
+    print('{:>10} {:>10} {:>10} {:>10} | phase'.format('rss KiB', 'peak KiB',
+            'heap KiB', 'heap peak'), file=out)
+    for p in data['phases']:
+        print('{:>10} {:>10} {:>10} {:>10} | {}'.format(kib(p['rss']),
+                kib(p['peak_rss']), kib(p.get('traced')),
+                kib(p.get('traced_peak')), p['phase']), file=out)
+    for stat in data.get('top', []):
+        print('{:>10} {:>6} | {}'.format(kib(stat['size']), stat['count'],
+                stat['site']), file=out)
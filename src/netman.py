@@ -4,32 +4,133 @@
 # to see the DBUS API that the python-NetworkManager module is communicating
 # over (the module documentation is scant).
 
-import NetworkManager
 import uuid
-import os
 import time
 import socket
-import json
+import heapq
+import threading
 
+import activation
+import config
+import log
+import supervisor
 
+logger = log.get('netman')
+
+
+#------------------------------------------------------------------------------
+# python-NetworkManager connects to the system bus as soon as it is imported,
+# so we only import it the first time something actually talks to NM.
+# set_backend() lets a script swap in another implementation of the same API.
+# The startup steps and the sampler thread may all get here first at once,
+# and there must only ever be one backend (a trace recorder opens its file).
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _load_backend()
+        return _backend
+
+
+def _load_backend():
+    cfg = config.get()
+    if cfg.nm_trace_replay:
+        import nmtrace
+        logger.info('Replaying NetworkManager from %s', cfg.nm_trace_replay)
+        return nmtrace.ReplayBackend(cfg.nm_trace_replay, cfg.nm_trace_speed)
+
+    # NM signals are only delivered through a GLib main loop, which has
+    # to be the dbus default before NetworkManager connects to the bus.
+    try:
+        from dbus.mainloop.glib import DBusGMainLoop
+        DBusGMainLoop(set_as_default=True)
+    except ImportError:
+        pass
+    import NetworkManager as backend
+
+    if cfg.nm_trace_record:
+        import nmtrace
+        logger.info('Recording NetworkManager to %s', cfg.nm_trace_record)
+        backend = nmtrace.RecordingBackend(backend, cfg.nm_trace_record)
+    return backend
+
+
+def set_backend(backend):
+    global _backend, _custom_backend, _state_listeners_installed
+    with _backend_lock:
+        _backend = backend
+        _custom_backend = True
+        _state_listeners_installed = False
+
+
+class _LazyBackend(object):
+    def __getattr__(self, name):
+        return getattr(get_backend(), name)
+
+
+NetworkManager = _LazyBackend()
+
+
+#------------------------------------------------------------------------------
+# Calls that read a lot (the AP list, the saved connections) or wait for a
+# signal go through the asyncio client in nmasync.py when dbus-next is
+# installed, so their D-Bus round trips overlap.  Everything else, and
+# every call when a trace or set_backend() is in use, goes through the
+# backend above.  If the async client fails once we stop using it.
+# nmasync (and with it asyncio and dbus-next) is only imported here, it
+# would double the time it takes to import this module.
+_custom_backend = False
+_async_failed = False
+
+
+def _use_async():
+    cfg = config.get()
+    if not cfg.nm_async or _async_failed or _custom_backend or \
+            cfg.nm_trace_replay or cfg.nm_trace_record:
+        return False
+    import nmasync
+    return nmasync.available()
+
+
+# nmasync.run(), or None (and no more async calls) if it fails.
+def _run_async(method, *args, **kwargs):
+    global _async_failed
+    try:
+        import nmasync
+        return nmasync.run(method, *args, **kwargs)
+    except Exception as e:
+        logger.warning('Async NetworkManager client failed (%s), using '
+                'python-NetworkManager.', e)
+        _async_failed = True
+        return None
+
+
+#------------------------------------------------------------------------------
+# A value from the balena supervisor's device info (see supervisor.py), for
+# ip_address the idx'th address.  Without the supervisor the IP address
+# comes from a hostname lookup, anything else is False.
 def bln_device_fetch(attribute='ip_address', idx=0):
-    bln_device = os.getenv('BALENA_SUPERVISOR_DEVICE', None)
-    if bln_device:
-        data = json.loads(bln_device)
-        host_ip = str(data[attribute])
-        print('Host IP address:', host_ip)
-        return host_ip.split(' ')[idx]
-    elif attribute == 'ip_address':
+    device = supervisor.device(wait=config.get().supervisor_timeout)
+    if device is not None:
+        if attribute == 'ip_address':
+            if len(device.ip_addresses) > idx:
+                logger.info('Host IP address: %s', device.ip_addresses[idx])
+                return device.ip_addresses[idx]
+        else:
+            return device.raw.get(attribute, False)
+    if attribute == 'ip_address':
         return get_Host_name_IP()
-    else:
-        return False
+    return False
 
 
 HOTSPOT_CONNECTION_NAME = 'hotspot'
 GENERIC_CONNECTION_NAME = 'python-wifi-connect'
-# use 'ip link show | grep qlen' to see list of interfaces
-DEFAULT_INTERFACE = os.getenv('DEFAULT_INTERFACE', 'wlan0')
-DEFAULT_GATEWAY = os.getenv('DEFAULT_GATEWAY', bln_device_fetch())
 
 
 #------------------------------------------------------------------------------
@@ -41,27 +142,352 @@ def have_active_internet_connection(host="8.8.8.8", port=53, timeout=2):
    Service: domain (DNS/TCP)
    """
    try:
-     socket.setdefaulttimeout(timeout)
-     socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-     return True
+     # Don't leak the socket or change the process wide default timeout,
+     # the daemon mode calls this over and over.
+     with socket.create_connection((host, port), timeout):
+       return True
    except Exception as e:
      #print("Exception: {}".format(e))
      return False
 
 
+#------------------------------------------------------------------------------
+# Returns True if NetworkManager reports full connectivity and we can reach
+# the internet.
+def have_uplink():
+    try:
+        if NetworkManager.NetworkManager.State != \
+                NetworkManager.NM_STATE_CONNECTED_GLOBAL:
+            return False
+    except Exception as e:
+        logger.warning('have_uplink error %s', e)
+    return have_active_internet_connection()
+
+
+#------------------------------------------------------------------------------
+# At boot NetworkManager may still be bringing up a saved connection, on the
+# radio we're about to take for the hotspot.  Wait while it is starting up
+# or connecting, for at most timeout seconds.  Returns True if it settled.
+NM_STATE_CONNECTING = 40
+AUTOCONNECT_POLL_SECS = 0.5
+
+def wait_for_autoconnect(timeout=15):
+    deadline = time.monotonic() + timeout
+    waited = False
+    while True:
+        try:
+            nm = NetworkManager.NetworkManager
+            busy = nm.State == NM_STATE_CONNECTING or \
+                    bool(getattr(nm, 'Startup', False)) # NM 1.0 and later
+        except Exception as e:
+            logger.warning('wait_for_autoconnect error %s', e)
+            return False
+        if not busy:
+            return True
+        if time.monotonic() >= deadline:
+            logger.warning('NetworkManager still connecting after %ss, '
+                    'going on.', timeout)
+            return False
+        if not waited:
+            logger.info('Waiting up to %ss for NetworkManager to finish '
+                    'connecting...', timeout)
+            waited = True
+        time.sleep(AUTOCONNECT_POLL_SECS)
+
+
+#------------------------------------------------------------------------------
+# Block until the uplink has been down for grace_period seconds.
+# Uses the NetworkManager StateChanged signal when a GLib main loop is
+# available, otherwise polls every poll_interval seconds.
+def wait_for_uplink_loss(grace_period=30, poll_interval=10):
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        return _poll_for_uplink_loss(grace_period, poll_interval)
+
+    loop = GLib.MainLoop()
+    timers = {}
+
+    def grace_expired():
+        timers.pop('grace', None)
+        if not have_uplink():
+            loop.quit()
+        return False # one shot
+
+    def state_changed(state):
+        if state == NetworkManager.NM_STATE_CONNECTED_GLOBAL:
+            if 'grace' in timers:
+                GLib.source_remove(timers.pop('grace'))
+        elif 'grace' not in timers:
+            logger.info('Uplink lost (state=%s), portal in %ss unless it '
+                    'comes back.', state, grace_period)
+            timers['grace'] = GLib.timeout_add_seconds(grace_period,
+                    grace_expired)
+
+    def poll():
+        # Safety net in case the link dies without NM noticing (e.g. the
+        # upstream router loses its internet).
+        if 'grace' not in timers and not have_active_internet_connection():
+            state_changed(None)
+        return True # keep polling
+
+    _state_listeners[:] = [state_changed]
+    if not _state_listeners_installed:
+        _install_state_listener()
+    timers['poll'] = GLib.timeout_add_seconds(max(poll_interval, 1) * 6, poll)
+    try:
+        if not have_uplink():
+            state_changed(None)
+        loop.run()
+    finally:
+        # Both live on the default main context, which outlives this loop:
+        # left there they'd keep firing into a loop that's gone.
+        _state_listeners[:] = []
+        for source in timers.values():
+            GLib.source_remove(source)
+
+
+_state_listeners = []
+_state_listeners_installed = False
+
+
+# NetworkManager handlers can't be unregistered, so we register one and
+# dispatch to whoever is waiting at the time.
+def _install_state_listener():
+    global _state_listeners_installed
+
+    def on_state_changed(nm, interface, signal, state):
+        for listener in list(_state_listeners):
+            listener(state)
+
+    NetworkManager.NetworkManager.OnStateChanged(on_state_changed)
+    _state_listeners_installed = True
+
+
+def _poll_for_uplink_loss(grace_period, poll_interval):
+    down_since = None
+    while True:
+        if have_uplink():
+            down_since = None
+        elif down_since is None:
+            down_since = time.time()
+        elif time.time() - down_since >= grace_period:
+            return
+        time.sleep(min(poll_interval, grace_period) or 1)
+
+
+#------------------------------------------------------------------------------
+# Wireless device capability bit for access point mode, see
+# https://developer.gnome.org/NetworkManager/1.2/nm-dbus-types.html#NMDeviceWifiCapabilities
+NM_WIFI_DEVICE_CAP_AP = 0x40
+
+
+#------------------------------------------------------------------------------
+# Return all the wifi devices NetworkManager knows about.
+def get_wifi_devices():
+    return [dev for dev in NetworkManager.NetworkManager.GetDevices()
+            if dev.DeviceType == NetworkManager.NM_DEVICE_TYPE_WIFI]
+
+
+#------------------------------------------------------------------------------
+# Find a wifi device by interface name, or by capability when the name is
+# 'auto' (or not found).  Devices named in exclude are skipped when picking
+# by capability.  Returns None if there is no suitable device.
+def find_wifi_device(interface='auto', need_ap=False, exclude=()):
+    return _pick_wifi_device(_named(get_wifi_devices()), interface, need_ap,
+            exclude)
+
+
+# (device, interface name) of each device, every property read is a D-Bus
+# round trip.
+def _named(devices):
+    return [(dev, dev.Interface) for dev in devices]
+
+
+def _pick_wifi_device(named, interface, need_ap=False, exclude=()):
+    if interface and interface != 'auto':
+        for dev, name in named:
+            if name == interface:
+                return dev
+        logger.warning('No wifi device named %s, picking one by capability.', interface)
+    for dev, name in named:
+        if name in exclude:
+            continue
+        if need_ap and not dev.WirelessCapabilities & NM_WIFI_DEVICE_CAP_AP:
+            continue
+        return dev
+    return None
+
+
+#------------------------------------------------------------------------------
+# The (hotspot device, station device) pair, from one look at the wifi
+# devices (or at devices, from get_wifi_devices()).  On a single radio unit
+# both are the same device.  Anything needing both, or one of them more than
+# once, should get the pair once and pass it on.
+def get_device_pair(devices=None):
+    cfg = config.get()
+    named = _named(get_wifi_devices() if devices is None else devices)
+    ap_dev = _pick_wifi_device(named, cfg.ap_interface, need_ap=True)
+    if cfg.sta_interface == cfg.ap_interface and cfg.ap_interface != 'auto':
+        return ap_dev, ap_dev
+    exclude = tuple(name for dev, name in named if dev is ap_dev)
+    sta_dev = _pick_wifi_device(named, cfg.sta_interface, exclude=exclude)
+    return ap_dev, sta_dev or ap_dev
+
+
+#------------------------------------------------------------------------------
+# The device our hotspot runs on.
+def get_ap_device():
+    return find_wifi_device(config.get().ap_interface, need_ap=True)
+
+
+#------------------------------------------------------------------------------
+# The device we scan and connect to the user's AP on.  On a single radio unit
+# this is the same device as the hotspot.
+def get_sta_device():
+    return get_device_pair()[1]
+
+
+#------------------------------------------------------------------------------
+# Returns the interface name the hotspot runs on (for dnsmasq).
+def get_ap_interface():
+    dev = get_ap_device()
+    if dev is None:
+        return config.get().interface
+    return dev.Interface
+
+
+#------------------------------------------------------------------------------
+# Returns True if the hotspot and the client connection use separate radios,
+# so we can scan and test a connection while the hotspot stays up.  pair is
+# from get_device_pair(), looked up if not given.
+def is_dual_interface(pair=None):
+    ap_dev, sta_dev = pair or get_device_pair()
+    if ap_dev is None or sta_dev is None:
+        return False
+    return ap_dev.object_path != sta_dev.object_path
+
+
+#------------------------------------------------------------------------------
+# The signal of the AP our client connection is on, as (strength in %,
+# bitrate in kbit/s, frequency in MHz), or None when there isn't one.
+# Pass the station device if you have it, finding it takes a D-Bus round
+# trip per property per wifi device.
+NM_802_11_MODE_INFRA = 2 # client mode, our hotspot is NM_802_11_MODE_AP
+
+def read_signal(dev=None):
+    if dev is None:
+        dev = get_sta_device()
+    if dev is None or dev.State != NetworkManager.NM_DEVICE_STATE_ACTIVATED \
+            or dev.Mode != NM_802_11_MODE_INFRA:
+        return None
+    ap = dev.ActiveAccessPoint
+    if ap is None or getattr(ap, 'object_path', None) == '/':
+        return None
+    return ap.Strength, dev.Bitrate, ap.Frequency
+
+
+#------------------------------------------------------------------------------
+# Compact snapshots of what we read from NetworkManager.  We copy the few
+# values we need out of the D-Bus proxies and let the proxies go, so a dense
+# RF environment doesn't keep a proxy (and its property cache) per AP alive.
+class AccessPoint(object):
+    __slots__ = ('ssid', 'security', 'strength')
+
+    def __init__(self, ssid, security, strength=0):
+        self.ssid = ssid
+        self.security = security
+        self.strength = strength
+
+    # What we send to the UI.
+    def as_dict(self):
+        return {'ssid': self.ssid, 'security': self.security}
+
+    def __repr__(self):
+        return '{}({})'.format(self.ssid, self.security)
+
+
+# json.dumps(..., default=netman.to_json) for lists of our records.
+def to_json(obj):
+    if hasattr(obj, 'as_dict'):
+        return obj.as_dict()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+# proxy is the python-NetworkManager connection it was read from, None when
+# the async client listed it.
+class ConnectionInfo(object):
+    __slots__ = ('id', 'type', 'uuid', 'path', 'proxy')
+
+    def __init__(self, id, type, uuid, path, proxy=None):
+        self.id = id
+        self.type = type
+        self.uuid = uuid
+        self.path = path
+        self.proxy = proxy
+
+
+#------------------------------------------------------------------------------
+# Return a ConnectionInfo for each connection NM knows about.
+def list_connections():
+    if _use_async():
+        connections = _run_async('connections')
+        if connections is not None:
+            return [ConnectionInfo(s['connection']['id'],
+                    s['connection']['type'], s['connection'].get('uuid'), path)
+                    for path, s in connections]
+
+    infos = []
+    for conn in NetworkManager.Settings.ListConnections():
+        settings = conn.GetSettings()['connection']
+        infos.append(ConnectionInfo(settings['id'], settings['type'],
+                settings.get('uuid'), conn.object_path, conn))
+    return infos
+
+
+#------------------------------------------------------------------------------
+# Return the ConnectionInfo with this id, or None.  If there are several the
+# last one wins.
+def find_connection(conn_name):
+    found = None
+    for info in list_connections():
+        if info.id == conn_name:
+            found = info
+    return found
+
+
+#------------------------------------------------------------------------------
+# Delete the connections (ConnectionInfo from list_connections()), returns
+# how many.  Those listed through python-NetworkManager carry their proxy,
+# the async client deletes the others by path.
+def delete_connections(infos):
+    deleted = 0
+    paths = []
+    for info in infos:
+        if info.proxy is not None:
+            info.proxy.Delete()
+            deleted += 1
+        else:
+            paths.append(info.path)
+    if paths:
+        count = _run_async('delete_connections', paths)
+        if count is None:
+            # The async client is gone, fall back to listing them again.
+            paths = set(paths)
+            count = delete_connections([info for info in list_connections()
+                                        if info.path in paths])
+        deleted += count
+    return deleted
+
+
 #------------------------------------------------------------------------------
 # Remove ALL wifi connections - to start clean or before running the hotspot.
 def delete_all_wifi_connections():
-    # Get all known connections
-    connections = NetworkManager.Settings.ListConnections()
-
-    # Delete the '802-11-wireless' connections
-    for connection in connections:
-        if connection.GetSettings()["connection"]["type"] == "802-11-wireless":
-            print("Deleting connection "
-                + connection.GetSettings()["connection"]["id"]
-            )
-            connection.Delete()
+    wifi = [info for info in list_connections()
+            if info.type == '802-11-wireless']
+    for info in wifi:
+        logger.info('Deleting connection %s', info.id)
+    delete_connections(wifi)
     time.sleep(2)
 
 
@@ -77,10 +503,9 @@ def stop_hotspot():
 def stop_connection(conn_name=GENERIC_CONNECTION_NAME):
     # Find the hotspot connection
     try:
-        connections = NetworkManager.Settings.ListConnections()
-        connections = dict([(x.GetSettings()['connection']['id'], x) for x in connections])
-        conn = connections[conn_name]
-        conn.Delete()
+        info = find_connection(conn_name)
+        if info is None or not delete_connections([info]):
+            return False
     except Exception as e:
         #print('stop_hotspot error ', e)
         return False
@@ -89,90 +514,164 @@ def stop_connection(conn_name=GENERIC_CONNECTION_NAME):
 
 
 #------------------------------------------------------------------------------
-# Return a list of available SSIDs and their security type,
-# or [] for none available or error.
-def get_list_of_access_points():
-    # bit flags we use when decoding what we get back from NetMan for each AP
-    NM_SECURITY_NONE       = 0x0
-    NM_SECURITY_WEP        = 0x1
-    NM_SECURITY_WPA        = 0x2
-    NM_SECURITY_WPA2       = 0x4
-    NM_SECURITY_ENTERPRISE = 0x8
-
-    ssids = [] # list we return
-
-    for dev in NetworkManager.NetworkManager.GetDevices():
-        if dev.DeviceType != NetworkManager.NM_DEVICE_TYPE_WIFI:
-            continue
-        for ap in dev.GetAccessPoints():
-
-            # Get Flags, WpaFlags and RsnFlags, all are bit OR'd combinations
-            # of the NM_802_11_AP_SEC_* bit flags.
-            # https://developer.gnome.org/NetworkManager/1.2/nm-dbus-types.html#NM80211ApSecurityFlags
+# bit flags we use when decoding what we get back from NetMan for each AP
+NM_SECURITY_NONE       = 0x0
+NM_SECURITY_WEP        = 0x1
+NM_SECURITY_WPA        = 0x2
+NM_SECURITY_WPA2       = 0x4
+NM_SECURITY_ENTERPRISE = 0x8
 
-            security = NM_SECURITY_NONE
 
-            # Based on a subset of the flag settings we can determine which
-            # type of security this AP uses.
-            # We can also determine what input we need from the user to connect to
-            # any given AP (required for our dynamic UI form).
-            if ap.Flags & NetworkManager.NM_802_11_AP_FLAGS_PRIVACY and \
-                    ap.WpaFlags == NetworkManager.NM_802_11_AP_SEC_NONE and \
-                    ap.RsnFlags == NetworkManager.NM_802_11_AP_SEC_NONE:
-                security = NM_SECURITY_WEP
-
-            if ap.WpaFlags != NetworkManager.NM_802_11_AP_SEC_NONE:
-                security = NM_SECURITY_WPA
-
-            if ap.RsnFlags != NetworkManager.NM_802_11_AP_SEC_NONE:
-                security = NM_SECURITY_WPA2
-
-            if ap.WpaFlags & NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X or \
-                    ap.RsnFlags & NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X:
-                security = NM_SECURITY_ENTERPRISE
-
-            #print('{ap.Ssid:15} Flags=0x{ap.Flags:X} WpaFlags=0x{ap.WpaFlags:X} RsnFlags=0x{ap.RsnFlags:X}')
+#------------------------------------------------------------------------------
+# Decode an AP's Flags, WpaFlags and RsnFlags into our security type string.
+# All are bit OR'd combinations of the NM_802_11_AP_SEC_* bit flags.
+# https://developer.gnome.org/NetworkManager/1.2/nm-dbus-types.html#NM80211ApSecurityFlags
+def classify_security(flags, wpa_flags, rsn_flags):
+    sec_none = NetworkManager.NM_802_11_AP_SEC_NONE
+    key_mgmt_8021x = NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X
+
+    security = NM_SECURITY_NONE
+
+    # Based on a subset of the flag settings we can determine which
+    # type of security this AP uses.
+    # We can also determine what input we need from the user to connect to
+    # any given AP (required for our dynamic UI form).
+    if flags & NetworkManager.NM_802_11_AP_FLAGS_PRIVACY and \
+            wpa_flags == sec_none and rsn_flags == sec_none:
+        security = NM_SECURITY_WEP
+
+    if wpa_flags != sec_none:
+        security = NM_SECURITY_WPA
+
+    if rsn_flags != sec_none:
+        security = NM_SECURITY_WPA2
+
+    if wpa_flags & key_mgmt_8021x or rsn_flags & key_mgmt_8021x:
+        security = NM_SECURITY_ENTERPRISE
+
+    # Decode our flag into a display string
+    if security & NM_SECURITY_ENTERPRISE:
+        return 'ENTERPRISE'
+    if security & NM_SECURITY_WPA2:
+        return 'WPA2'
+    if security & NM_SECURITY_WPA:
+        return 'WPA'
+    if security & NM_SECURITY_WEP:
+        return 'WEP'
+    return 'NONE'
 
-            # Decode our flag into a display string
-            security_str = ''
-            if security == NM_SECURITY_NONE:
-                security_str = 'NONE'
 
-            if security & NM_SECURITY_WEP:
-                security_str = 'WEP'
+#------------------------------------------------------------------------------
+# (ssid, flags, wpa flags, rsn flags, strength) of the APs the devices see.
+def _read_access_points(devices):
+    if _use_async():
+        aps = _run_async('access_points', [dev.object_path for dev in devices])
+        if aps is not None:
+            return [(bytes(ap.get('Ssid', b'')).decode('utf-8', 'replace'),
+                     ap.get('Flags', 0), ap.get('WpaFlags', 0),
+                     ap.get('RsnFlags', 0), ap.get('Strength', 0))
+                    for ap in aps]
 
-            if security & NM_SECURITY_WPA:
-                security_str = 'WPA'
+    # Read each property once, they are D-Bus round trips.
+    return [(ap.Ssid, ap.Flags, ap.WpaFlags, ap.RsnFlags, ap.Strength)
+            for dev in devices for ap in dev.GetAccessPoints()]
 
-            if security & NM_SECURITY_WPA2:
-                security_str = 'WPA2'
 
-            if security & NM_SECURITY_ENTERPRISE:
-                security_str = 'ENTERPRISE'
+#------------------------------------------------------------------------------
+# Return a list of AccessPoint for the available SSIDs and their security
+# type, or [] for none available or error.  At most max_access_points
+# (strongest first) are kept, plus the hidden network place holder.
+def get_list_of_access_points():
+    ssids = [] # list we return
+    seen = {} # (ssid, security) -> index in ssids, issue #8
+
+    # With two radios only the station device sees the networks around us,
+    # the AP device is busy running our hotspot.
+    devices = get_wifi_devices()
+    pair = get_device_pair(devices)
+    if is_dual_interface(pair):
+        devices = [pair[1]]
+
+    for ssid, flags, wpa_flags, rsn_flags, strength in \
+            _read_access_points(devices):
+        # Don't add other PFC's to the list!
+        if ssid.startswith('Raspibox-'):
+            continue
 
-            entry = {"ssid": ap.Ssid, "security": security_str}
+        entry = AccessPoint(ssid,
+                classify_security(flags, wpa_flags, rsn_flags), strength)
 
-            # Don't add duplicates to the list, issue #8
-            if ssids.__contains__(entry):
-                continue
+        # Don't add duplicates to the list, but keep the strongest.
+        key = (entry.ssid, entry.security)
+        if key in seen:
+            other = ssids[seen[key]]
+            other.strength = max(other.strength, entry.strength)
+            continue
 
-            # Don't add other PFC's to the list!
-            if ap.Ssid.startswith('Raspibox-'):
-                continue
+        seen[key] = len(ssids)
+        ssids.append(entry)
 
-            ssids.append(entry)
+    max_aps = config.get().max_access_points
+    if max_aps and len(ssids) > max_aps:
+        strongest = set(id(ap) for ap in
+                heapq.nlargest(max_aps, ssids, key=lambda ap: ap.strength))
+        ssids = [ap for ap in ssids if id(ap) in strongest]
 
     # always add a hidden place holder
-    ssids.append({"ssid": "Enter a hidden WiFi name", "security": "HIDDEN"})
+    ssids.append(AccessPoint("Enter a hidden WiFi name", "HIDDEN"))
 
-    print('Available SSIDs: {}'.format(ssids))
+    # the list can be long, don't build the string unless we write it
+    if logger.isEnabledFor(log.DEBUG):
+        logger.debug('Available SSIDs: %s', ', '.join(ap.ssid for ap in ssids))
+    logger.info('Found %d networks.', len(ssids))
     return ssids
 
 
+#------------------------------------------------------------------------------
+# Ask NetworkManager for a fresh scan and return the new list of access
+# points.  Waits up to timeout seconds for the scan to finish.  Returns None
+# if no device would scan.  Don't call this on a single radio unit while
+# the hotspot is up: in AP mode NM only sees our own hotspot.
+SCAN_POLL_SECS = 0.25
+SCAN_SETTLE_SECS = 3 # wait when NM is too old to tell us (no LastScan)
+
+def rescan(timeout=10):
+    devices = get_wifi_devices()
+    pair = get_device_pair(devices)
+    if is_dual_interface(pair):
+        devices = [pair[1]]
+
+    pending = [] # (device, LastScan before the request)
+    for dev in devices:
+        try:
+            try:
+                last = dev.LastScan # NM 1.12 and later
+            except Exception:
+                last = None
+            dev.RequestScan({})
+            pending.append((dev, last))
+        except Exception as e:
+            logger.warning('Scan request on %s failed: %s', dev.Interface, e)
+    if not pending:
+        return None
+
+    if any(last is None for dev, last in pending):
+        timeout = min(timeout, SCAN_SETTLE_SECS)
+        pending = [(dev, None) for dev, last in pending]
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        pending = [(dev, last) for dev, last in pending
+                   if last is None or dev.LastScan == last]
+        if pending:
+            time.sleep(SCAN_POLL_SECS)
+
+    return get_list_of_access_points()
+
+
 #------------------------------------------------------------------------------
 # Get hotspot SSID name.
 def get_hotspot_SSID():
-    return 'Raspibox-'+os.getenv('RESIN_DEVICE_NAME_AT_INIT','aged-cheese')
+    return 'Raspibox-'+config.get().device_name
 
 
 #------------------------------------------------------------------------------
@@ -191,19 +690,74 @@ CONN_TYPE_SEC_PASSWORD   = 'PASSWORD' # WPA, WPA2 and WEP
 CONN_TYPE_SEC_ENTERPRISE = 'ENTERPRISE' # MIT SECURE
 
 
+ACTIVATION_POLL_SECS = 0.5
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_DEVICE_STATE_PREPARE = 40 # the first state of an activation
+NM_DEVICE_STATE_FAILED = 120
+
+
+# Wait until dev is activated, the activation fails or the
+# (time.monotonic()) deadline passes, and return the device state.  A failed
+# activation (e.g. a wrong password) ends in FAILED and then DISCONNECTED.
+# With leave_first the device was activated (on the connection we're
+# switching from) and only counts as activated again after it left that
+# state; if it never does we return None.  With the async client this waits
+# for the StateChanged signals, otherwise polls.
+def _wait_for_activation(dev, deadline, leave_first=False):
+    activated = NetworkManager.NM_DEVICE_STATE_ACTIVATED
+    if _use_async():
+        remaining = max(0, deadline - time.monotonic())
+        state = _run_async('wait_for_device_state', dev.object_path,
+                activated, remaining, leave_first, timeout=remaining + 5)
+        if state is not None:
+            return state
+    started = False
+    left = not leave_first
+    while True:
+        state = dev.State
+        if state != activated:
+            left = True
+        elif left:
+            return state
+        if state == NM_DEVICE_STATE_FAILED:
+            return state
+        if NM_DEVICE_STATE_PREPARE <= state < activated:
+            started = True
+        elif state == NM_DEVICE_STATE_DISCONNECTED and started:
+            return state
+        if time.monotonic() >= deadline:
+            return state if left else None
+        time.sleep(ACTIVATION_POLL_SECS)
+
+
 #------------------------------------------------------------------------------
 # Generic connect to the user selected AP function.
 # Returns True for success, or False.
+# pair is from get_device_pair(), looked up if not given.
 def connect_to_AP(conn_type=None, conn_name=GENERIC_CONNECTION_NAME, \
-        ssid=None, username=None, password=None):
+        ssid=None, username=None, password=None, pair=None):
 
     #print("connect_to_AP conn_type={conn_type} conn_name={conn_name} ssid={ssid} username={username} password={password}")
 
     if conn_type is None or ssid is None:
-        print('connect_to_AP() Error: Missing args conn_type or ssid')
+        logger.error('connect_to_AP() Error: Missing args conn_type or ssid')
         return False
 
     try:
+        # Pick the radio for this connection: the hotspot goes on the AP
+        # device, everything else on the station device.
+        pair = pair or get_device_pair()
+        dev = pair[0] if conn_type == CONN_TYPE_HOTSPOT else pair[1]
+        if dev is None:
+            logger.error('connect_to_AP() Error: No wifi device found.')
+            return False
+        interface = dev.Interface
+        # Only the hotspot needs our address, don't go looking for it
+        # otherwise.
+        gateway = None
+        if conn_type == CONN_TYPE_HOTSPOT:
+            gateway = config.get().gateway
+
         # This is the hotspot that we turn on, on the RPI so we can show our
         # captured portal to let the user select an AP and provide credentials.
         hotspot_dict = {
@@ -212,12 +766,12 @@ def connect_to_AP(conn_type=None, conn_name=GENERIC_CONNECTION_NAME, \
                                 'ssid': ssid},
             'connection': {'autoconnect': False,
                            'id': conn_name,
-                           'interface-name': DEFAULT_INTERFACE,
+                           'interface-name': interface,
                            'type': '802-11-wireless',
                            'uuid': str(uuid.uuid4())},
             'ipv4': {'address-data':
-                        [{'address': DEFAULT_GATEWAY, 'prefix': 24}],
-                     'gateway': DEFAULT_GATEWAY,
+                        [{'address': gateway, 'prefix': 24}],
+                     'gateway': gateway,
                      'method': 'manual'},
             'ipv6': {'method': 'auto'}
         }
@@ -287,53 +841,65 @@ def connect_to_AP(conn_type=None, conn_name=GENERIC_CONNECTION_NAME, \
             conn_str = 'ENTERPRISE'
 
         if conn_dict is None:
-            print('connect_to_AP() Error: Invalid conn_type="{}"'.format(conn_type))
+            logger.error('connect_to_AP() Error: Invalid conn_type="%s"', conn_type)
             return False
 
-        #print("new connection {conn_dict} type={conn_str}")
+        # Bind client connections to the station radio so NM does not try
+        # to bring them up on the radio running our hotspot.
+        if conn_type != CONN_TYPE_HOTSPOT and is_dual_interface(pair):
+            conn_dict['connection']['interface-name'] = interface
 
-        NetworkManager.Settings.AddConnection(conn_dict)
-        print("Added connection {conn_name} of type {conn_str}")
+        #print("new connection {conn_dict} type={conn_str}")
 
-        # Now find this connection and its device
-        connections = NetworkManager.Settings.ListConnections()
-        connections = dict([(x.GetSettings()['connection']['id'], x) for x in connections])
-        conn = connections[conn_name]
+        # AddConnection gives us the new connection, no need to look it up.
+        conn = NetworkManager.Settings.AddConnection(conn_dict)
+        logger.info('Added connection %s of type %s', conn_name, conn_str)
 
-        # Find a suitable device
-        ctype = conn.GetSettings()['connection']['type']
-        dtype = {'802-11-wireless': NetworkManager.NM_DEVICE_TYPE_WIFI}.get(ctype,ctype)
-        devices = NetworkManager.NetworkManager.GetDevices()
+        # How long this kind of connection took before, see activation.py.
+        history = activation.get()
+        timeout = history.timeout(conn_type, ssid)
 
-        for dev in devices:
-            if dev.DeviceType == dtype:
-                break
-        else:
-            print("connect_to_AP() Error: No suitable and available {} device found.".format(ctype))
-            return False
+        # With two radios the station device may still be up on the old
+        # connection (e.g. the router lost its internet), which mustn't pass
+        # for the new one.
+        leave_first = dev.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED
 
         # And connect
+        started = time.monotonic()
+        deadline = started + timeout
         NetworkManager.NetworkManager.ActivateConnection(conn, dev, "/")
-        print("Activated connection={}.".format(conn_name))
+        logger.info('Activated connection=%s on %s.', conn_name, interface)
 
         # Wait for ADDRCONF(NETDEV_CHANGE): wlan0: link becomes ready
-        print('Waiting for connection to become active...')
-        loop_count = 0
-        while dev.State != NetworkManager.NM_DEVICE_STATE_ACTIVATED:
-            #print('dev.State={}'.format(dev.State))
-            time.sleep(1)
-            loop_count += 1
-            if loop_count > 30: # only wait 30 seconds max
-                break
-
-        if dev.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
-            print('Connection {} is live.'.format(conn_name))
+        logger.info('Waiting up to %.0fs for connection to become active...',
+                timeout)
+        state = _wait_for_activation(dev, deadline, leave_first)
+
+        if state == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
+            elapsed = time.monotonic() - started
+            history.record(conn_type, ssid, elapsed)
+            logger.info('Connection %s is live after %.1fs.', conn_name, elapsed)
             return True
+        # Only running out of time says anything about the time it needs,
+        # a wrong password fails just as fast next time.
+        if time.monotonic() >= deadline:
+            history.record(conn_type, ssid, None)
+            # Otherwise NM keeps at it and holds the radio we're about to
+            # put the hotspot back on.  Deleting it deactivates it too.
+            logger.info('Connection %s timed out, deleting it.', conn_name)
+            try:
+                conn.Delete()
+            except Exception as e:
+                logger.warning('Unable to delete connection %s: %s',
+                        conn_name, e)
+        else:
+            logger.info('Connection %s failed to activate (state %s).',
+                    conn_name, state)
 
     except Exception as e:
-        print('Connection error {}'.format(e))
+        logger.error('Connection error %s', e)
 
-    print('Connection {} failed.'.format(conn_name))
+    logger.warning('Connection %s failed.', conn_name)
     return False
 
 # Python3 code to display hostname and
@@ -344,10 +910,9 @@ def get_Host_name_IP():
     try:
         host_name = socket.gethostname()
         host_ip = socket.gethostbyname(host_name)
-        print("Hostname : ", host_name)
-        print("IP : ", host_ip)
+        logger.info('Hostname: %s IP: %s', host_name, host_ip)
         return host_ip
     except Exception as e:
-        print("Unable to get Hostname and IP : \n", e)
+        logger.warning('Unable to get Hostname and IP: %s', e)
 
     return False
@@ -0,0 +1,267 @@
+# asyncio client for NetworkManager.
+#
+# python-NetworkManager reads every property with its own blocking D-Bus
+# round trip, so listing 40 APs is 200 round trips one after the other.
+# This client sends raw messages with dbus-next on one connection, so any
+# number of calls can be in flight at once: all the APs are read with one
+# GetAll each, all sent together.  Signals are delivered as async
+# iterators (see Subscription).
+#
+# dbus-next is optional.  Without it available() is False and netman keeps
+# using python-NetworkManager.  netman calls in here through run(), which
+# runs the coroutine on a loop thread shared by the whole process.
+
+import asyncio, concurrent.futures, threading
+
+try:
+    from dbus_next import BusType, Message, MessageType, Variant
+    from dbus_next.aio import MessageBus
+except ImportError:
+    MessageBus = None
+
+NM_BUS_NAME = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_IFACE = 'org.freedesktop.NetworkManager'
+DEVICE_IFACE = NM_IFACE + '.Device'
+WIRELESS_IFACE = NM_IFACE + '.Device.Wireless'
+AP_IFACE = NM_IFACE + '.AccessPoint'
+SETTINGS_PATH = NM_PATH + '/Settings'
+SETTINGS_IFACE = NM_IFACE + '.Settings'
+SETTINGS_CONN_IFACE = NM_IFACE + '.Settings.Connection'
+PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_DEVICE_STATE_PREPARE = 40 # the first state of an activation
+NM_DEVICE_STATE_FAILED = 120
+
+DEFAULT_TIMEOUT = 30 # seconds run() waits for a result
+
+
+class NMError(Exception):
+    pass
+
+
+def available():
+    return MessageBus is not None
+
+
+# Variants (and containers of them) to plain values.
+def unwrap(value):
+    if isinstance(value, Variant):
+        return unwrap(value.value)
+    if isinstance(value, dict):
+        return dict((k, unwrap(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [unwrap(v) for v in value]
+    return value
+
+
+#------------------------------------------------------------------------------
+# Signals matching interface / member (and path), as an async iterator of
+# (path, args).  Use as an async context manager, so the match rule is
+# added before you read the state you're waiting to change:
+#
+#     async with client.subscribe(DEVICE_IFACE, 'StateChanged', path) as sub:
+#         ...
+#         async for path, (new, old, reason) in sub:
+class Subscription(object):
+
+    def __init__(self, client, interface, member, path=None):
+        self.client = client
+        self.interface = interface
+        self.member = member
+        self.path = path
+        self.rule = "type='signal',interface='{}',member='{}'".format(
+                interface, member)
+        if path:
+            self.rule += ",path='{}'".format(path)
+        self.queue = asyncio.Queue()
+
+    def _handler(self, msg):
+        if msg.message_type == MessageType.SIGNAL and \
+                msg.interface == self.interface and \
+                msg.member == self.member and \
+                (self.path is None or msg.path == self.path):
+            self.queue.put_nowait((msg.path, unwrap(msg.body)))
+
+    async def __aenter__(self):
+        self.client.bus.add_message_handler(self._handler)
+        await self.client.bus_call('AddMatch', self.rule)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.client.bus.remove_message_handler(self._handler)
+        try:
+            await self.client.bus_call('RemoveMatch', self.rule)
+        except (NMError, EOFError, OSError):
+            pass # the bus went away, and the rule with it
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+
+#------------------------------------------------------------------------------
+class NMClient(object):
+
+    def __init__(self):
+        self.bus = None
+
+    async def connect(self):
+        if MessageBus is None:
+            raise NMError('dbus-next is not installed')
+        self.bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        return self
+
+    def close(self):
+        if self.bus is not None:
+            self.bus.disconnect()
+            self.bus = None
+
+    # One method call, returns the reply body.  Raises NMError for D-Bus
+    # errors.
+    async def call(self, path, interface, member, signature='', body=(),
+            destination=NM_BUS_NAME):
+        reply = await self.bus.call(Message(destination=destination,
+                path=path, interface=interface, member=member,
+                signature=signature, body=list(body)))
+        if reply.message_type == MessageType.ERROR:
+            raise NMError('{}: {}'.format(reply.error_name,
+                    reply.body[0] if reply.body else ''))
+        return reply.body
+
+    async def bus_call(self, member, rule):
+        return await self.call('/org/freedesktop/DBus',
+                'org.freedesktop.DBus', member, 's', [rule],
+                destination='org.freedesktop.DBus')
+
+    async def get(self, path, interface, name):
+        body = await self.call(path, PROPS_IFACE, 'Get', 'ss',
+                [interface, name])
+        return unwrap(body[0])
+
+    async def get_all(self, path, interface):
+        body = await self.call(path, PROPS_IFACE, 'GetAll', 's', [interface])
+        return unwrap(body[0])
+
+    # GetAll for many (path, interface) at once.
+    async def get_all_many(self, pairs):
+        return await asyncio.gather(*[self.get_all(path, interface)
+                                      for path, interface in pairs])
+
+    def subscribe(self, interface, member, path=None):
+        return Subscription(self, interface, member, path)
+
+    # Properties of the APs each device (by path) sees, with 'path' added.
+    async def access_points(self, device_paths):
+        lists = await asyncio.gather(*[
+                self.call(path, WIRELESS_IFACE, 'GetAccessPoints')
+                for path in device_paths])
+        paths = [path for body in lists for path in body[0]]
+        aps = await self.get_all_many([(p, AP_IFACE) for p in paths])
+        for path, props in zip(paths, aps):
+            props['path'] = path
+        return aps
+
+    # (path, settings) of every saved connection.
+    async def connections(self):
+        body = await self.call(SETTINGS_PATH, SETTINGS_IFACE,
+                'ListConnections')
+        paths = body[0]
+        settings = await asyncio.gather(*[
+                self.call(path, SETTINGS_CONN_IFACE, 'GetSettings')
+                for path in paths])
+        return [(path, unwrap(s[0])) for path, s in zip(paths, settings)]
+
+    # Delete saved connections by path, returns how many.
+    async def delete_connections(self, paths):
+        await asyncio.gather(*[self.call(path, SETTINGS_CONN_IFACE, 'Delete')
+                               for path in paths])
+        return len(paths)
+
+    # Wait for a device to reach state, from its StateChanged signals, or
+    # for the attempt to get there to fail: FAILED, or DISCONNECTED after
+    # it started.  With leave_first the device is in state already (from an
+    # earlier activation) and has to leave it first.  Returns the state it's
+    # in when that happens or time runs out, None if it never left state.
+    async def wait_for_device_state(self, device_path, state, timeout,
+            leave_first=False):
+        async with self.subscribe(DEVICE_IFACE, 'StateChanged',
+                device_path) as changes:
+            current = await self.get(device_path, DEVICE_IFACE, 'State')
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + timeout
+            started = False
+            left = not leave_first
+            while current != NM_DEVICE_STATE_FAILED:
+                if current != state:
+                    left = True
+                elif left:
+                    break
+                if NM_DEVICE_STATE_PREPARE <= current < state:
+                    started = True
+                elif current == NM_DEVICE_STATE_DISCONNECTED and started:
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    path, args = await asyncio.wait_for(changes.__anext__(),
+                            remaining)
+                except asyncio.TimeoutError:
+                    break
+                current = args[0] # new, old, reason
+            if current == state and not left:
+                return None
+            return current
+
+
+#------------------------------------------------------------------------------
+# The loop thread and client shared by the sync wrappers in netman.
+_loop = None
+_client = None
+_client_lock = None # asyncio.Lock, made on the loop it's used from
+_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                    name='nmasync')
+            thread.daemon = True
+            thread.start()
+        return _loop
+
+
+# The first callers all wait for the one connect, rather than each making
+# their own bus connection and all but the last leaking.
+async def shared_client():
+    global _client, _client_lock
+    if _client is None:
+        # Only the loop thread gets here, so this check is safe.
+        if _client_lock is None:
+            _client_lock = asyncio.Lock()
+        async with _client_lock:
+            if _client is None:
+                _client = await NMClient().connect()
+    return _client
+
+
+# Call NMClient.<method>(*args) on the shared client from a plain thread and
+# return the result.  Raises NMError (or the connection error), or
+# TimeoutError after cancelling the call, so it isn't left running.
+def run(method, *args, timeout=DEFAULT_TIMEOUT):
+    async def call():
+        client = await shared_client()
+        return await getattr(client, method)(*args)
+    future = asyncio.run_coroutine_threadsafe(call(), _get_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
@@ -0,0 +1,422 @@
+# Record and replay the NetworkManager D-Bus traffic of netman (or any
+# script using python-NetworkManager).
+#
+# Recording wraps the python-NetworkManager module: every property read,
+# property write, method call and signal goes to a JSON lines trace file
+# with its arguments, result and how long it really took.  Replaying feeds
+# the trace back through an object with the same API, sleeping for the
+# recorded latencies, so a startup or connect sequence from the field can be
+# rerun on any Linux box and optimizations measured against real timings.
+#
+# netman uses these when NM_TRACE_RECORD or NM_TRACE_REPLAY are set.
+# For the nm_scripts tools (or any other script) use the command line:
+#   python3 src/nmtrace.py record trace.jsonl nm_scripts/show_current_AP.py
+#   python3 src/nmtrace.py replay trace.jsonl nm_scripts/show_current_AP.py
+#   python3 src/nmtrace.py summary trace.jsonl
+
+import json, sys, threading, time, collections
+
+TRACE_VERSION = 1
+
+
+#------------------------------------------------------------------------------
+# Errors raised by replayed calls that failed when they were recorded.
+class ReplayError(Exception):
+    pass
+
+
+#------------------------------------------------------------------------------
+# Connection setting keys holding secrets.  Traces get pulled off units in
+# the field and shared, so these never make it into one.
+SECRET_KEYS = frozenset([
+    'psk', 'password', 'password-raw', 'leap-password', 'pin',
+    'wep-key0', 'wep-key1', 'wep-key2', 'wep-key3',
+    'private-key', 'private-key-password', 'phase2-private-key-password',
+    'ca-cert-password', 'client-cert-password',
+    'phase2-ca-cert-password', 'phase2-client-cert-password',
+    'preshared-key', 'secrets',
+])
+REDACTED = '<redacted>'
+
+
+#------------------------------------------------------------------------------
+# Convert a value to something JSON can hold.  NM objects are stored as
+# their object path, secrets (see SECRET_KEYS) as REDACTED.
+def encode(value):
+    if hasattr(value, 'object_path') and not isinstance(value, type):
+        return {'$obj': value.object_path}
+    if isinstance(value, dict):
+        return dict((str(k), REDACTED if str(k) in SECRET_KEYS else encode(v))
+                    for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, bytes):
+        return {'$bytes': list(value)}
+    if value is None or isinstance(value, str):
+        return None if value is None else str(value)
+    return {'$repr': repr(value)}
+
+
+def _object_path(value):
+    if isinstance(value, _RecordingProxy):
+        return object.__getattribute__(value, '_path')
+    return getattr(value, 'object_path', None)
+
+
+#==============================================================================
+# Recording
+
+#------------------------------------------------------------------------------
+# Writes trace events, one JSON object per line.
+class Recorder(object):
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def write(self, event):
+        event['t'] = round(time.time() - self._start, 6)
+        line = json.dumps(event)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+#------------------------------------------------------------------------------
+# Stands in for an NM object and records everything done through it.
+class _RecordingProxy(object):
+
+    def __init__(self, target, recorder):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_path', target.object_path)
+
+    def __getattr__(self, name):
+        target = object.__getattribute__(self, '_target')
+        recorder = object.__getattribute__(self, '_recorder')
+        path = object.__getattribute__(self, '_path')
+        if name == 'object_path':
+            return path
+
+        t0 = time.time()
+        value = getattr(target, name)
+        latency = time.time() - t0
+
+        if callable(value) and not hasattr(value, 'object_path'):
+            if name.startswith('On'):
+                return _recording_signal(value, path, name[2:], recorder)
+            return _recording_method(value, path, name, recorder)
+
+        recorder.write({'type': 'get', 'path': path, 'name': name,
+                'value': encode(value), 'latency': round(latency, 6)})
+        return _wrap(value, recorder)
+
+    def __setattr__(self, name, value):
+        target = object.__getattribute__(self, '_target')
+        recorder = object.__getattribute__(self, '_recorder')
+        t0 = time.time()
+        setattr(target, name, _unwrap(value))
+        recorder.write({'type': 'set',
+                'path': object.__getattribute__(self, '_path'), 'name': name,
+                'value': encode(value),
+                'latency': round(time.time() - t0, 6)})
+
+    def __eq__(self, other):
+        return _object_path(self) == _object_path(other)
+
+    def __hash__(self):
+        return hash(object.__getattribute__(self, '_path'))
+
+    def __repr__(self):
+        return '<recording {}>'.format(object.__getattribute__(self, '_path'))
+
+
+def _wrap(value, recorder):
+    if hasattr(value, 'object_path') and not isinstance(value, type):
+        return _RecordingProxy(value, recorder)
+    if isinstance(value, list):
+        return [_wrap(v, recorder) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_wrap(v, recorder) for v in value)
+    return value
+
+
+def _unwrap(value):
+    if isinstance(value, _RecordingProxy):
+        return object.__getattribute__(value, '_target')
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+def _recording_method(method, path, name, recorder):
+    def call(*args, **kwargs):
+        t0 = time.time()
+        event = {'type': 'call', 'path': path, 'name': name,
+                 'args': encode(args), 'kwargs': encode(kwargs)}
+        try:
+            value = method(*_unwrap(args), **dict((k, _unwrap(v))
+                    for k, v in kwargs.items()))
+        except Exception as e:
+            event['error'] = '{}: {}'.format(type(e).__name__, e)
+            event['latency'] = round(time.time() - t0, 6)
+            recorder.write(event)
+            raise
+        event['value'] = encode(value)
+        event['latency'] = round(time.time() - t0, 6)
+        recorder.write(event)
+        return _wrap(value, recorder)
+    return call
+
+
+def _recording_signal(subscribe, path, signal, recorder):
+    def on_signal(handler, *args, **kwargs):
+        def recorded(obj, *signal_args, **signal_kwargs):
+            recorder.write({'type': 'signal', 'path': path, 'name': signal,
+                    'args': encode(signal_args),
+                    'kwargs': encode(signal_kwargs)})
+            return handler(_wrap(obj, recorder), *signal_args, **signal_kwargs)
+        recorder.write({'type': 'subscribe', 'path': path, 'name': signal})
+        return subscribe(recorded, *args, **kwargs)
+    return on_signal
+
+
+#------------------------------------------------------------------------------
+# Stands in for the python-NetworkManager module, recording into path.
+class RecordingBackend(object):
+
+    def __init__(self, module, path):
+        self._module = module
+        self._recorder = Recorder(path)
+        self._objects = {}
+        constants = dict((name, getattr(module, name)) for name in dir(module)
+                if name.isupper() and isinstance(getattr(module, name), int))
+        objects = {}
+        for name in dir(module):
+            value = getattr(module, name)
+            if hasattr(value, 'object_path') and not isinstance(value, type):
+                objects[name] = value.object_path
+        self._recorder.write({'type': 'header', 'version': TRACE_VERSION,
+                'constants': constants, 'objects': objects})
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if hasattr(value, 'object_path') and not isinstance(value, type):
+            if name not in self._objects:
+                self._objects[name] = _RecordingProxy(value, self._recorder)
+            return self._objects[name]
+        return value
+
+    def close(self):
+        self._recorder.close()
+
+
+#==============================================================================
+# Replay
+
+#------------------------------------------------------------------------------
+# Stands in for the python-NetworkManager module, playing back a trace.
+# speed scales the recorded latencies, 0 replays without sleeping.
+class ReplayBackend(object):
+
+    def __init__(self, path, speed=1.0):
+        self._speed = speed
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self._queues = collections.defaultdict(collections.deque)
+        self._last = {}
+        self._signals = collections.defaultdict(list)
+        self._objects = {}
+        self._module_objects = {}
+        self._constants = {}
+
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                kind = event['type']
+                if kind == 'header':
+                    self._constants = event['constants']
+                    self._module_objects = event['objects']
+                elif kind == 'signal':
+                    self._signals[(event['path'], event['name'])].append(event)
+                elif kind in ('get', 'set', 'call'):
+                    self._queues[(kind, event['path'], event['name'])].append(event)
+
+    def __getattr__(self, name):
+        if name in self._constants:
+            return self._constants[name]
+        if name in self._module_objects:
+            return self.get_object(self._module_objects[name])
+        raise AttributeError(name)
+
+    # Objects are cached per path so identity and equality work as usual.
+    def get_object(self, path):
+        with self._lock:
+            if path not in self._objects:
+                self._objects[path] = _ReplayObject(path, self)
+            return self._objects[path]
+
+    # The next recorded event for this key.  Once they run out, the last one
+    # repeats (e.g. a state polled more often than when recorded).
+    def next_event(self, kind, path, name):
+        key = (kind, path, name)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                self._last[key] = queue.popleft()
+            return self._last.get(key)
+
+    def has_events(self, kind, path, name):
+        key = (kind, path, name)
+        return bool(self._queues.get(key)) or key in self._last
+
+    def wait(self, event):
+        if self._speed and event.get('latency'):
+            time.sleep(event['latency'] * self._speed)
+
+    def decode(self, value):
+        if isinstance(value, dict):
+            if '$obj' in value:
+                return self.get_object(value['$obj'])
+            if '$bytes' in value:
+                return bytes(value['$bytes'])
+            if '$repr' in value:
+                return value['$repr']
+            return dict((k, self.decode(v)) for k, v in value.items())
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        return value
+
+    # Deliver the recorded signals to a new handler, at the same offsets
+    # from the start of the replay as they had when recorded.
+    def subscribe(self, obj, path, signal, handler):
+        elapsed = time.time() - self._start
+        for event in self._signals.get((path, signal), []):
+            delay = max(0.0, event['t'] * (self._speed or 0) - elapsed)
+            args = self.decode(event['args'])
+            kwargs = self.decode(event['kwargs'])
+            timer = threading.Timer(delay, handler, [obj] + args, kwargs)
+            timer.daemon = True
+            timer.start()
+
+
+class _ReplayObject(object):
+
+    def __init__(self, path, replay):
+        self.object_path = path
+        self._replay = replay
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        replay = self._replay
+        path = self.object_path
+
+        if name.startswith('On') and not replay.has_events('get', path, name):
+            def on_signal(handler, *args, **kwargs):
+                replay.subscribe(self, path, name[2:], handler)
+            return on_signal
+
+        if replay.has_events('call', path, name):
+            def call(*args, **kwargs):
+                event = replay.next_event('call', path, name)
+                replay.wait(event)
+                if event.get('error'):
+                    raise ReplayError(event['error'])
+                return replay.decode(event.get('value'))
+            return call
+
+        event = replay.next_event('get', path, name)
+        if event is None:
+            raise AttributeError('{} has no recorded {}'.format(path, name))
+        replay.wait(event)
+        return replay.decode(event['value'])
+
+    def __setattr__(self, name, value):
+        if name in ('object_path', '_replay'):
+            object.__setattr__(self, name, value)
+            return
+        event = self._replay.next_event('set', self.object_path, name)
+        if event is not None:
+            self._replay.wait(event)
+
+    def __repr__(self):
+        return '<replay {}>'.format(self.object_path)
+
+
+#------------------------------------------------------------------------------
+# Per call timings of a trace: count, total and max latency for each
+# property / method, slowest total first.
+def summarize(path):
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            if 'latency' not in event:
+                continue
+            key = '{} {}'.format(event['type'], event['name'])
+            count, total, slowest = stats.get(key, (0, 0.0, 0.0))
+            stats[key] = (count + 1, total + event['latency'],
+                    max(slowest, event['latency']))
+    return sorted(stats.items(), key=lambda i: i[1][1], reverse=True)
+
+
+#------------------------------------------------------------------------------
+# Run a script with its NetworkManager module recorded / replayed.
+def run_script(backend, script, args):
+    import runpy
+    sys.modules['NetworkManager'] = backend
+    sys.argv = [script] + list(args)
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    usage = ''\
+'Usage: nmtrace.py record <trace file> <script> [script args]\n'\
+'       nmtrace.py replay [-s speed] <trace file> <script> [script args]\n'\
+'       nmtrace.py summary <trace file>\n'
+
+    argv = sys.argv[1:]
+    if len(argv) < 2:
+        print(usage)
+        sys.exit(2)
+
+    action = argv.pop(0)
+    if action == 'summary':
+        print('{:>6} {:>10} {:>10}  call'.format('count', 'total [s]', 'max [s]'))
+        for key, (count, total, slowest) in summarize(argv[0]):
+            print('{:>6} {:>10.4f} {:>10.4f}  {}'.format(count, total,
+                    slowest, key))
+
+    elif action == 'record' and len(argv) >= 2:
+        import NetworkManager
+        backend = RecordingBackend(NetworkManager, argv[0])
+        try:
+            run_script(backend, argv[1], argv[2:])
+        finally:
+            backend.close()
+
+    elif action == 'replay':
+        speed = 1.0
+        if argv[0] == '-s':
+            speed = float(argv[1])
+            argv = argv[2:]
+        if len(argv) < 2:
+            print(usage)
+            sys.exit(2)
+        run_script(ReplayBackend(argv[0], speed), argv[1], argv[2:])
+
+    else:
+        print(usage)
+        sys.exit(2)
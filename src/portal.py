@@ -0,0 +1,92 @@
+# Server side rendering of the portal page.
+#
+# ui/index.html is served as a single response with the network list, the
+# registration code, the critical CSS and our JS already in it, so the form
+# is usable after one round trip on a lossy hotspot link.  The template
+# still works when served as a plain file, it then fetches what it needs.
+
+import html, json, threading
+
+import netman
+
+# Markers in ui/index.html we fill in.
+CSS_MARKER = '<link rel="stylesheet" href="/css/portal.css" data-inline>'
+JS_MARKER = '<script src="/js/index.js" data-inline></script>'
+STATE_MARKER = '<script id="portal-state" type="application/json"></script>'
+SELECT_MARKER = "<select id='ssid-select' class=\"form-control\" name='ssid'></select>"
+REGCODE_MARKER = '<input class="form-control" id="regcode" readonly value=""></input>'
+REG_ROW_MARKER = '<div class="row reg-row">'
+
+# Form groups to show for each security type, like showHideFormFields() in
+# index.js does once the page has loaded.
+FORM_GROUPS = {
+    'NONE': (),
+    'ENTERPRISE': ('identity-group', 'passphrase-group'),
+    'HIDDEN': ('hidden-ssid-group', 'passphrase-group'),
+}
+PASSWORD_GROUPS = ('passphrase-group',)
+
+
+#------------------------------------------------------------------------------
+# Render the page.  ui_cache is the dict of URL path -> (content type, bytes)
+# from http_server.load_ui_cache(), ssids a list of netman.AccessPoint.
+def render(ui_cache, ssids, rcode):
+    page = ui_cache['/index.html'][1].decode('utf-8')
+
+    def inline(marker, path, tag):
+        if path not in ui_cache:
+            return page
+        content = ui_cache[path][1].decode('utf-8')
+        # a closing tag inside the content would end our inline block early
+        content = content.replace('</' + tag, '<\\/' + tag)
+        return page.replace(marker, '<{}>\n{}</{}>'.format(tag, content, tag))
+
+    page = inline(CSS_MARKER, '/css/portal.css', 'style')
+    page = inline(JS_MARKER, '/js/index.js', 'script')
+
+    state = json.dumps({'networks': ssids, 'regcode': rcode},
+            default=netman.to_json)
+    page = page.replace(STATE_MARKER,
+            '<script id="portal-state" type="application/json">{}</script>'.format(
+                state.replace('<', '\\u003c')))
+
+    options = ''.join(
+            '<option val="{0}" data-security="{1}">{0}</option>'.format(
+                html.escape(ap.ssid), html.escape(ap.security.upper()))
+            for ap in ssids)
+    page = page.replace(SELECT_MARKER, SELECT_MARKER.replace('></select>',
+            '>{}</select>'.format(options)))
+
+    if rcode:
+        page = page.replace(REGCODE_MARKER, REGCODE_MARKER.replace('value=""',
+                'value="{}"'.format(html.escape(rcode))))
+    else:
+        page = page.replace(REG_ROW_MARKER, '<div class="row reg-row hidden">')
+
+    # Show the fields the first network in the list needs.
+    if ssids:
+        security = ssids[0].security.upper()
+        for group in FORM_GROUPS.get(security, PASSWORD_GROUPS):
+            page = page.replace('<div class="form-group hidden" id="{}">'.format(group),
+                    '<div class="form-group" id="{}">'.format(group))
+
+    return page.encode('utf-8')
+
+
+#------------------------------------------------------------------------------
+# The last rendered page, re-rendered only when the network list (tracked by
+# a version number) or the registration code change.
+class PageCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._page = None
+
+    def get(self, ui_cache, ssids, version, rcode):
+        key = (version, rcode)
+        with self._lock:
+            if key != self._key:
+                self._page = render(ui_cache, ssids, rcode)
+                self._key = key
+            return self._page
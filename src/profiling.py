@@ -0,0 +1,99 @@
+# Startup profiling for the --profile-startup flag.
+# Records how long each module takes to import (like 'python -X importtime',
+# which python3.6 does not have) and how long each startup phase takes, then
+# prints a report once the portal is ready.
+
+import builtins, sys, threading, time
+from contextlib import contextmanager
+
+_enabled = False
+_reported = False
+_start = None
+_imports = [] # (depth, module name, self secs, cumulative secs)
+_phases = [] # (phase name, secs)
+# Import nesting depth and time spent in nested imports, per thread: the
+# startup pipeline imports on several threads at once, and one thread's
+# imports mustn't count as another's children.
+_stack = threading.local()
+
+
+#------------------------------------------------------------------------------
+# Start profiling.  Must be called before the modules we want to time are
+# imported.
+def start():
+    global _enabled, _start
+    if _enabled:
+        return
+    _enabled = True
+    _start = time.time()
+    real_import = builtins.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        # Only first time imports cost anything worth reporting.
+        if level or name in sys.modules:
+            return real_import(name, globals, locals, fromlist, level)
+
+        depth = getattr(_stack, 'depth', 0)
+        outer_child_time = getattr(_stack, 'child_time', 0.0)
+        _stack.child_time = 0.0
+        _stack.depth = depth + 1
+        t0 = time.time()
+        try:
+            return real_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.time() - t0
+            _stack.depth = depth
+            # list.append is atomic, no lock needed.
+            _imports.append((depth, name, cumulative - _stack.child_time,
+                    cumulative))
+            _stack.child_time = outer_child_time + cumulative
+
+    builtins.__import__ = timed_import
+
+
+#------------------------------------------------------------------------------
+def enabled():
+    return _enabled
+
+
+#------------------------------------------------------------------------------
+# Time a startup phase:  with profiling.phase('scan'): ...
+@contextmanager
+def phase(name):
+    if not _enabled:
+        yield
+        return
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        add_phase(name, time.time() - t0)
+
+
+#------------------------------------------------------------------------------
+# Record a phase timed elsewhere (e.g. by the startup pipeline).
+def add_phase(name, secs):
+    if _enabled:
+        _phases.append((name, secs))
+
+
+#------------------------------------------------------------------------------
+# Print the report (only once, only if profiling was started).
+def report(top=20, out=None):
+    global _reported
+    if not _enabled or _reported:
+        return
+    _reported = True
+    out = out or sys.stderr
+
+    print('Startup profile, {:.3f}s to ready.'.format(time.time() - _start),
+            file=out)
+    print('{:>10} | {:>10} | imported module'.format('self [us]',
+            'cumul [us]'), file=out)
+    slowest = sorted(_imports, key=lambda i: i[3], reverse=True)[:top]
+    for depth, name, self_time, cumulative in slowest:
+        print('{:>10} | {:>10} | {}{}'.format(int(self_time * 1e6),
+                int(cumulative * 1e6), '  ' * depth, name), file=out)
+    print('{:>10} | startup phase'.format('secs'), file=out)
+    for name, secs in _phases:
+        print('{:>10.3f} | {}'.format(secs, name), file=out)
@@ -0,0 +1,244 @@
+# Signal history of the AP our client connection is on.
+#
+# A thread reads the strength, bitrate and frequency of the active AP every
+# few seconds into a fixed size ring buffer.  That's six D-Bus property
+# reads on the station device, which is looked up once, and again only
+# after a read fails (e.g. a USB dongle was unplugged).  The buffer is
+# preallocated arrays, so sampling for days allocates nothing and the
+# memory use is known up front (18 bytes a sample).
+#
+# The stats (min / mean / percentiles over the last N seconds) are served
+# on /admin/signal, and the raw samples as a compact binary dump on
+# /admin/signal.bin, which this module can also decode:
+#
+#   python3 sampler.py show <dump file>
+#   python3 sampler.py run [-i interval] [-n samples] [-o dump file]
+
+import array, bisect, struct, sys, threading, time
+
+import activation
+import config
+import log
+import netman
+
+logger = log.get('sampler')
+
+# Windows (in seconds) the stats are reported for by default.
+WINDOWS = (60, 300, 3600)
+PERCENTILES = (5, 50, 95)
+
+# Binary dump: header, then one record per sample, oldest first.
+DUMP_MAGIC = b'WCSS'
+DUMP_VERSION = 1
+DUMP_HEADER = struct.Struct('<4sHHI') # magic, version, record size, count
+DUMP_RECORD = struct.Struct('<dhII') # time, strength, bitrate, frequency
+
+
+#------------------------------------------------------------------------------
+# Fixed capacity ring buffer of samples, oldest overwritten first.
+class RingBuffer(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._times = array.array('d', [0.0]) * capacity
+        self._strength = array.array('h', [0]) * capacity
+        self._bitrate = array.array('I', [0]) * capacity
+        self._frequency = array.array('I', [0]) * capacity
+        self._next = 0 # where the next sample goes
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, t, strength, bitrate, frequency):
+        with self._lock:
+            i = self._next
+            self._times[i] = t
+            self._strength[i] = strength
+            self._bitrate[i] = bitrate
+            self._frequency[i] = frequency
+            self._next = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    # Indexes of the stored samples, oldest first.
+    def _order(self):
+        start = (self._next - self._count) % self.capacity
+        return [(start + n) % self.capacity for n in range(self._count)]
+
+    # The samples since time since (all if None), oldest first, as a list
+    # of (time, strength, bitrate, frequency).
+    def samples(self, since=None):
+        with self._lock:
+            order = self._order()
+            if since is not None:
+                # times only go up, so the window is a tail of the buffer
+                times = [self._times[i] for i in order]
+                order = order[bisect.bisect_left(times, since):]
+            return [(self._times[i], self._strength[i], self._bitrate[i],
+                     self._frequency[i]) for i in order]
+
+    # Stats of the last window seconds, see summarize().
+    def stats(self, window, now=None):
+        now = time.time() if now is None else now
+        return summarize(self.samples(now - window))
+
+    def dump(self):
+        samples = self.samples()
+        return DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, DUMP_RECORD.size,
+                len(samples)) + b''.join(DUMP_RECORD.pack(*s) for s in samples)
+
+
+#------------------------------------------------------------------------------
+# min / mean / percentiles / max of each value in samples.
+def summarize(samples):
+    result = {'count': len(samples)}
+    if not samples:
+        return result
+    for n, name in enumerate(('strength', 'bitrate', 'frequency'), 1):
+        values = sorted(s[n] for s in samples)
+        entry = {'min': values[0], 'max': values[-1],
+                 'mean': round(float(sum(values)) / len(values), 1)}
+        for pct in PERCENTILES:
+            entry['p{}'.format(pct)] = activation.percentile(values, pct)
+        result[name] = entry
+    result['last'] = samples[-1][1:]
+    return result
+
+
+# Decode a dump() into a list of samples.
+def load_dump(data):
+    magic, version, size, count = DUMP_HEADER.unpack_from(data)
+    if magic != DUMP_MAGIC or version != DUMP_VERSION:
+        raise ValueError('Not a signal dump')
+    offset = DUMP_HEADER.size
+    return [DUMP_RECORD.unpack_from(data, offset + n * size)
+            for n in range(count)]
+
+
+#------------------------------------------------------------------------------
+# Samples netman.read_signal() of the device find_device() returns every
+# interval seconds into a RingBuffer.
+class Sampler(object):
+
+    def __init__(self, interval, capacity, read=netman.read_signal,
+            find_device=netman.get_sta_device):
+        self.interval = interval
+        self.buffer = RingBuffer(capacity)
+        self.read = read
+        self.find_device = find_device
+        self.device = None
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sample(self):
+        try:
+            if self.device is None:
+                self.device = self.find_device()
+                if self.device is None:
+                    return
+            signal = self.read(self.device)
+        except Exception as e:
+            self.errors += 1
+            self.device = None # find it again next time
+            logger.debug('Signal read error %s', e)
+            return
+        if signal is not None:
+            self.buffer.add(time.time(), *signal)
+
+    def _run(self):
+        # Keep to the interval however long a read takes.
+        next_time = time.time()
+        while not self._stop.is_set():
+            self.sample()
+            next_time += self.interval
+            self._stop.wait(max(0, next_time - time.time()))
+
+    # What /admin/signal returns.
+    def report(self, windows=WINDOWS):
+        now = time.time()
+        return {'interval': self.interval, 'capacity': self.buffer.capacity,
+                'samples': len(self.buffer), 'errors': self.errors,
+                'windows': dict((str(w), self.buffer.stats(w, now))
+                                for w in windows)}
+
+
+_sampler = None
+
+
+#------------------------------------------------------------------------------
+# Start the process wide sampler from config, if it's enabled.
+def start():
+    global _sampler
+    cfg = config.get()
+    if _sampler is None and cfg.signal_interval > 0:
+        _sampler = Sampler(cfg.signal_interval, cfg.signal_samples)
+        _sampler.start()
+    return _sampler
+
+
+# The process wide sampler, or None if it's not running.
+def get():
+    return _sampler
+
+
+#------------------------------------------------------------------------------
+def show(path):
+    with open(path, 'rb') as f:
+        samples = load_dump(f.read())
+    for t, strength, bitrate, frequency in samples:
+        print('{} {:3d}% {:6d} kbit/s {:5d} MHz'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)),
+                strength, bitrate, frequency))
+    print(summarize(samples))
+
+
+# Sample standalone, print the stats every minute, dump on exit.
+def run(args):
+    import getopt
+    cfg = config.get()
+    interval, capacity, out = cfg.signal_interval or 10, cfg.signal_samples, None
+    opts, args = getopt.getopt(args, 'i:n:o:')
+    for opt, arg in opts:
+        if opt == '-i':
+            interval = float(arg)
+        elif opt == '-n':
+            capacity = int(arg)
+        elif opt == '-o':
+            out = arg
+
+    sampler = Sampler(interval, capacity)
+    sampler.start()
+    try:
+        while True:
+            time.sleep(60)
+            print(sampler.report()['windows'])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sampler.stop()
+        if out:
+            with open(out, 'wb') as f:
+                f.write(sampler.buffer.dump())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'show':
+        show(sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'run':
+        run(sys.argv[2:])
+    else:
+        print('Usage: sampler.py show <dump file>\n'
+              '       sampler.py run [-i interval] [-n samples] [-o dump file]')
+        sys.exit(1)
@@ -0,0 +1,85 @@
+# On demand rescans of the wifi networks, for POST /networks/refresh.
+#
+# Scanning takes the radio off channel for a few seconds.  So there's at
+# most one scan at a time and everyone asking while it runs gets its result,
+# and after a scan we answer from it for min_interval seconds instead of
+# scanning again.  However many phones press refresh, it costs one scan.
+# When available() says we can't scan at all (on a single radio unit the
+# radio is running our hotspot), we answer with what we have.
+
+import threading, time
+
+import log
+
+logger = log.get('scanner')
+
+
+#------------------------------------------------------------------------------
+# scan() returns the list of networks, or None if it couldn't scan (see
+# netman.rescan()).
+class Scanner(object):
+
+    def __init__(self, scan, min_interval=30, available=None):
+        self.scan = scan
+        self.min_interval = min_interval
+        self.available = available
+        self.networks = []
+        self.finished = None # time.monotonic() the last scan ended
+        self.duration = None # seconds the last scan took
+        self._lock = threading.Lock()
+        self._flight = None # set when the running scan is done
+
+    # Take the result of a scan made elsewhere (e.g. at startup).
+    def seed(self, networks, duration=None):
+        with self._lock:
+            self.networks = networks
+            self.finished = time.monotonic()
+            self.duration = duration
+
+    # Scan unless we did so lately, or join the running scan.  Returns a
+    # dict of the networks, whether we scanned for this request, the age
+    # of the result and how long the scan took.
+    def refresh(self, timeout=None):
+        with self._lock:
+            flight = self._flight
+            if flight is None:
+                if self.finished is not None and \
+                        time.monotonic() - self.finished < self.min_interval:
+                    return self._result('cached')
+                if self.available is not None and not self.available():
+                    return self._result('unavailable')
+                flight = self._flight = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            flight.wait(timeout)
+            with self._lock:
+                return self._result('shared')
+
+        started = time.monotonic()
+        try:
+            networks = self.scan()
+        except Exception as e:
+            logger.warning('Scan failed: %s', e)
+            networks = None
+        with self._lock:
+            if networks is not None:
+                self.networks = networks
+            # a failed scan is rate limited too
+            self.finished = time.monotonic()
+            self.duration = self.finished - started
+            self._flight = None
+            result = self._result('scanned' if networks is not None
+                    else 'failed')
+        flight.set()
+        return result
+
+    def _result(self, status):
+        age = None
+        if self.finished is not None:
+            age = round(time.monotonic() - self.finished, 1)
+        return {'status': status, 'networks': self.networks, 'age': age,
+                'duration': None if self.duration is None
+                            else round(self.duration, 2)}
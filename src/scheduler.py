@@ -0,0 +1,198 @@
+# One connection attempt at a time.
+#
+# Every connect stops the hotspot (on one radio) and ties up the radio for
+# up to half a minute, so overlapping attempts just fight each other.  All
+# POST /connect requests go through a ConnectScheduler instead:
+#  - a submission identical to the running or queued attempt joins it
+#    (double clicks, a client retrying),
+#  - a different one waits in a short queue, or is turned away when the
+#    queue is full,
+#  - each client gets a token bucket, so one client can't keep the radio
+#    busy.
+# Jobs run one after the other on the scheduler's thread.
+
+import collections, threading, time
+
+import log
+
+logger = log.get('scheduler')
+
+# What submit() did with a request.
+STARTED = 'started'
+COALESCED = 'coalesced'
+QUEUED = 'queued'
+BUSY = 'busy'
+RATE_LIMITED = 'rate-limited'
+CLOSED = 'closed'
+
+
+#------------------------------------------------------------------------------
+# rate tokens a second, up to burst.
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Seconds until take() can succeed.
+    def wait_time(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1 or not self.rate:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+#------------------------------------------------------------------------------
+# One connection attempt.  key identifies identical submissions.
+class ConnectJob(object):
+
+    def __init__(self, client, ssid, conn_type, username=None, password=None):
+        self.client = client
+        self.ssid = ssid
+        self.conn_type = conn_type
+        self.username = username
+        self.password = password
+        self.key = (ssid, conn_type, username, password)
+        self.result = None # True / False once done
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.result
+
+
+#------------------------------------------------------------------------------
+# Runs run_job(job) for submitted jobs, one at a time.  run_job returns True
+# when we're connected, after which nothing else is run.
+class ConnectScheduler(object):
+
+    def __init__(self, run_job, rate=1 / 30.0, burst=3, max_queue=1,
+            max_clients=256):
+        self.run_job = run_job
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_clients = max_clients
+        self.running = None
+        self.queue = collections.deque()
+        self.closed = False
+        self._buckets = collections.OrderedDict() # client -> TokenBucket
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name='connect')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Returns (status, job, retry_after).  job is None unless the request
+    # was accepted, retry_after is in seconds when it wasn't.
+    def submit(self, job):
+        with self._lock:
+            if self.closed:
+                return CLOSED, None, None
+
+            for other in [self.running] + list(self.queue):
+                if other is not None and other.key == job.key:
+                    return COALESCED, other, None
+
+            # A client that changed its mind replaces its queued attempt.
+            replaces = None
+            for n, other in enumerate(self.queue):
+                if other.client == job.client:
+                    replaces = n
+            idle = self.running is None and not self.queue
+            if replaces is None and not idle and \
+                    len(self.queue) >= self.max_queue:
+                return BUSY, None, None
+
+            # Only an attempt we take costs a token.
+            bucket = self._bucket(job.client)
+            if not bucket.take():
+                return RATE_LIMITED, None, bucket.wait_time()
+
+            if replaces is not None:
+                other = self.queue[replaces]
+                self.queue[replaces] = job
+                self._finish(other, None)
+                return QUEUED, job, None
+            self.queue.append(job)
+            if idle:
+                self._wakeup.notify()
+                return STARTED, job, None
+            return QUEUED, job, None
+
+    # Position of a job, 0 for running, None if it's not waiting.
+    def position(self, job):
+        with self._lock:
+            if job is self.running:
+                return 0
+            for n, other in enumerate(self.queue, 1):
+                if other is job:
+                    return n
+        return None
+
+    # Stop taking jobs, the queued ones are dropped.
+    def close(self):
+        with self._lock:
+            self.closed = True
+            dropped = list(self.queue)
+            self.queue.clear()
+            self._wakeup.notify()
+        for job in dropped:
+            self._finish(job, None)
+
+    def _bucket(self, client):
+        bucket = self._buckets.pop(client, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            # forget the least recently seen clients
+            while len(self._buckets) >= self.max_clients:
+                self._buckets.popitem(last=False)
+        self._buckets[client] = bucket
+        return bucket
+
+    def _finish(self, job, result):
+        job.result = result
+        job.done.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self.queue and not self.closed:
+                    self._wakeup.wait()
+                if self.closed:
+                    return
+                job = self.running = self.queue.popleft()
+
+            result = False
+            try:
+                result = bool(self.run_job(job))
+            except Exception:
+                logger.exception('Connecting to %s failed', job.ssid)
+
+            with self._lock:
+                self.running = None
+                if result:
+                    self.closed = True
+                    dropped = list(self.queue)
+                    self.queue.clear()
+                else:
+                    dropped = []
+            self._finish(job, result)
+            for other in dropped:
+                self._finish(other, None)
+            if result:
+                return
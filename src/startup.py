@@ -0,0 +1,104 @@
+# Run the portal startup as a small dependency graph.
+# Each step runs in its own thread as soon as the steps it depends on are
+# done, so independent work (binding the socket, loading the UI, preparing
+# dnsmasq) overlaps with the slow NetworkManager calls.
+
+import threading, time
+
+import log
+import profiling
+
+logger = log.get('startup')
+
+
+#------------------------------------------------------------------------------
+# One startup step.  func is called with a dict of the results of the steps
+# it depends on (by name) and its return value becomes this step's result.
+class Step(object):
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+#------------------------------------------------------------------------------
+# Run all the steps and return a dict of their results by name.
+# If a step raises, the steps that depend on it are skipped and the first
+# error is re-raised here once everything else has finished (this includes
+# SystemExit, so a step can still exit the app).
+def run(steps):
+    by_name = dict((step.name, step) for step in steps)
+    for step in steps:
+        for dep in step.deps:
+            if dep not in by_name:
+                raise ValueError('Step {} depends on unknown step {}'.format(
+                        step.name, dep))
+
+    def run_step(step):
+        try:
+            for dep in step.deps:
+                by_name[dep].done.wait()
+            failed = [d for d in step.deps if by_name[d].error is not None]
+            if failed:
+                step.error = by_name[failed[0]].error
+                return
+            step.started = time.time()
+            step.result = step.func(dict((d, by_name[d].result)
+                    for d in step.deps))
+        except BaseException as e:
+            step.error = e
+        finally:
+            step.finished = step.finished or time.time()
+            step.done.set()
+
+    threads = []
+    for step in steps:
+        t = threading.Thread(target=run_step, args=(step,),
+                name='startup-' + step.name)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    for step in steps:
+        if step.started is not None:
+            profiling.add_phase(step.name, step.duration())
+
+    path = critical_path(steps)
+    logger.info('Startup critical path: %s (%.2fs)',
+            ' -> '.join('{} {:.2f}s'.format(s.name, s.duration()) for s in path),
+            sum(s.duration() for s in path))
+
+    for step in steps:
+        if step.error is not None:
+            raise step.error
+    return dict((step.name, step.result) for step in steps)
+
+
+#------------------------------------------------------------------------------
+# The chain of steps that decided when startup finished: start from the
+# step that finished last and keep following the dependency that finished
+# last.
+def critical_path(steps):
+    by_name = dict((step.name, step) for step in steps)
+    ran = [step for step in steps if step.finished is not None]
+    if not ran:
+        return []
+    step = max(ran, key=lambda s: s.finished)
+    path = [step]
+    while step.deps:
+        step = max((by_name[d] for d in step.deps),
+                key=lambda s: s.finished or 0)
+        path.insert(0, step)
+    return path
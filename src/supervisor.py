@@ -0,0 +1,195 @@
+# Client for the balena supervisor's device API.
+#
+# The device info (our IP addresses etc.) is fetched in the background with
+# a timeout and retries, and cached in memory and on disk for ttl seconds,
+# so a restart doesn't have to ask again and nothing at startup blocks on
+# the supervisor unless it has to have the answer.
+#
+# The supervisor is found with the BALENA_SUPERVISOR_ADDRESS and
+# BALENA_SUPERVISOR_API_KEY variables balena gives the container, so any
+# local HTTP server answering GET /v1/device can stand in for it.
+
+import json, os, threading, time
+
+import config
+import log
+
+logger = log.get('supervisor')
+
+
+#------------------------------------------------------------------------------
+# What GET /v1/device tells us, with the types fixed up.
+class DeviceInfo(object):
+    __slots__ = ('ip_addresses', 'mac_addresses', 'os_version',
+            'supervisor_version', 'status', 'commit', 'update_pending',
+            'raw')
+
+    def __init__(self, raw):
+        self.raw = raw # the JSON we got, for anything else
+        self.ip_addresses = (raw.get('ip_address') or '').split()
+        self.mac_addresses = (raw.get('mac_address') or '').split()
+        self.os_version = raw.get('os_version')
+        self.supervisor_version = raw.get('supervisor_version')
+        self.status = raw.get('status')
+        self.commit = raw.get('commit')
+        self.update_pending = bool(raw.get('update_pending'))
+
+    # The first IP address, or None.
+    @property
+    def ip_address(self):
+        return self.ip_addresses[0] if self.ip_addresses else None
+
+
+class SupervisorError(Exception):
+    pass
+
+
+#------------------------------------------------------------------------------
+class SupervisorClient(object):
+
+    def __init__(self, address, api_key, cache_path=None, ttl=300,
+            timeout=5, retries=3):
+        self.address = address.rstrip('/') if address else None
+        self.api_key = api_key
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retries = retries
+        self._device = None
+        self._fetched = 0 # time._device was fetched
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+
+    def _fresh(self, fetched):
+        return time.time() - fetched < self.ttl
+
+    # GET /v1/device, with retries.  Raises SupervisorError.
+    def fetch(self):
+        if not self.address:
+            raise SupervisorError('No supervisor address')
+        from urllib.parse import urlencode
+        from urllib.request import Request, urlopen # slow to import
+        url = '{}/v1/device?{}'.format(self.address,
+                urlencode({'apikey': self.api_key or ''}))
+        request = Request(url, headers={'Content-Type': 'application/json'})
+        error = None
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(min(2 ** (attempt - 1), 10))
+            try:
+                with urlopen(request, timeout=self.timeout) as response:
+                    raw = json.loads(response.read().decode('utf-8'))
+                break
+            except (OSError, ValueError) as e:
+                error = e
+                logger.debug('Supervisor request failed: %s', e)
+        else:
+            raise SupervisorError('Supervisor unavailable: {}'.format(error))
+
+        self._store(raw, time.time())
+        self._save(raw)
+        return self._device
+
+    def _store(self, raw, fetched):
+        with self._lock:
+            self._device = DeviceInfo(raw)
+            self._fetched = fetched
+
+    def _load(self):
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            fetched, raw = cached['time'], cached['device']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if not self._fresh(fetched):
+            return False
+        self._store(raw, fetched)
+        return True
+
+    def _save(self, raw):
+        if not self.cache_path:
+            return
+        try:
+            tmp = self.cache_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'time': time.time(), 'device': raw}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logger.warning('Unable to cache the device info: %s', e)
+
+    # Fetch in the background, unless a fetch is running or the cache is
+    # fresh.
+    def prefetch(self):
+        if not self.address:
+            return
+        with self._lock:
+            if self._device is not None and self._fresh(self._fetched):
+                return
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._done.clear()
+            self._thread = threading.Thread(target=self._background,
+                    name='supervisor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _background(self):
+        try:
+            self.fetch()
+        except SupervisorError as e:
+            logger.warning('%s', e)
+        finally:
+            self._done.set()
+
+    # The device info: from memory or the disk cache if fresh, otherwise
+    # waits up to wait seconds for a fetch.  Returns None if we don't know.
+    # A stale answer is better than none, it's returned while refreshing.
+    def device(self, wait=0):
+        with self._lock:
+            device, fetched = self._device, self._fetched
+        if device is not None and self._fresh(fetched):
+            return device
+        if device is None and self._load():
+            return self._device
+        self.prefetch()
+        if wait and self.address:
+            self._done.wait(wait)
+        with self._lock:
+            return self._device
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+#------------------------------------------------------------------------------
+# The process wide client, from config.  The device info run.sh used to
+# put in BALENA_SUPERVISOR_DEVICE is still used when it's there.
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            cfg = config.get()
+            _client = SupervisorClient(cfg.supervisor_address,
+                    cfg.supervisor_api_key, cfg.supervisor_cache,
+                    cfg.supervisor_ttl, cfg.supervisor_timeout)
+            legacy = os.environ.get('BALENA_SUPERVISOR_DEVICE')
+            if legacy:
+                try:
+                    _client._store(json.loads(legacy), time.time())
+                except (ValueError, AttributeError):
+                    pass # not JSON, or not the device object
+        return _client
+
+
+# Start fetching the device info, so it's there when it's needed.
+def prefetch():
+    get_client().prefetch()
+
+
+def device(wait=0):
+    return get_client().device(wait)
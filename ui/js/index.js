@@ -1,62 +1,208 @@
-$(function(){
-    var networks = undefined;
+// Portal page logic, no libraries needed.
+// When the server renders the page it embeds the network list and the
+// registration code in #portal-state, otherwise we fetch them.
+document.addEventListener('DOMContentLoaded', function(){
+    var select = document.getElementById('ssid-select');
+
+    function byId(id) {
+        return document.getElementById(id);
+    }
+
+    function show(id, visible) {
+        byId(id).classList[visible ? 'remove' : 'add']('hidden');
+    }
+
+    function eachElement(selector, fn) {
+        Array.prototype.forEach.call(document.querySelectorAll(selector), fn);
+    }
+
+    function get(url, callback) {
+        var xhr = new XMLHttpRequest();
+        xhr.onload = function(){
+            if(xhr.status === 200) {
+                callback(xhr.responseText);
+            }
+        };
+        xhr.open('GET', url);
+        xhr.send();
+    }
+
+    function selectedSecurity() {
+        var option = select.options[select.selectedIndex];
+        return option ? option.getAttribute('data-security') : undefined;
+    }
 
     function showHideFormFields() {
-        var security = $(this).find(':selected').attr('data-security');
+        var security = selectedSecurity();
         // start off with all fields hidden
-        $('#identity-group').addClass('hidden');
-        $('#passphrase-group').addClass('hidden');
-        $('#hidden-ssid-group').addClass('hidden');
-        if(security === 'NONE') {
+        show('identity-group', false);
+        show('passphrase-group', false);
+        show('hidden-ssid-group', false);
+        if(security === undefined || security === 'NONE') {
             return; // nothing to do
         }
         if(security === 'ENTERPRISE') {
-            $('#identity-group').removeClass('hidden');
-            $('#passphrase-group').removeClass('hidden');
+            show('identity-group', true);
+            show('passphrase-group', true);
             return;
-        } 
+        }
         if(security === 'HIDDEN') {
-            $('#hidden-ssid-group').removeClass('hidden');
+            show('hidden-ssid-group', true);
             // fall through
-        } 
+        }
         // otherwise security is HIDDEN, WEP, WPA, or WPA2 which need password
-        $('#passphrase-group').removeClass('hidden');
+        show('passphrase-group', true);
     }
 
-    $('#ssid-select').change(showHideFormFields);
+    select.addEventListener('change', showHideFormFields);
 
-    $.get("/regcode", function(data){
-        if(data.length !== 0){
-            $('#regcode').val(data);
-        } else { 
-            $('.reg-row').hide(); // no reg code, so hide that part of the UI
-	}
-    });
-
-    $.get("/networks", function(data){
-        if(data.length === 0){
-            $('.before-submit').hide();
-            $('#no-networks-message').removeClass('hidden');
+    function showRegcode(regcode) {
+        if(regcode.length !== 0){
+            byId('regcode').value = regcode;
         } else {
-            networks = JSON.parse(data);
-            $.each(networks, function(i, val){
-                $('#ssid-select').append(
-                    $('<option>')
-                        .text(val.ssid)
-                        .attr('val', val.ssid)
-                        .attr('data-security', val.security.toUpperCase())
-                );
-            });
+            // no reg code, so hide that part of the UI
+            eachElement('.reg-row', function(el){ el.classList.add('hidden'); });
+        }
+    }
+
+    function networkOption(val) {
+        var option = document.createElement('option');
+        option.textContent = val.ssid;
+        option.setAttribute('val', val.ssid);
+        option.setAttribute('data-security', val.security.toUpperCase());
+        return option;
+    }
 
-            jQuery.proxy(showHideFormFields, $('#ssid-select'))();
+    function findOption(val) {
+        return Array.prototype.filter.call(select.options, function(option){
+            return option.getAttribute('val') === val.ssid &&
+                option.getAttribute('data-security') === val.security.toUpperCase();
+        })[0];
+    }
+
+    function showNetworks(networks) {
+        if(networks.length === 0){
+            eachElement('.before-submit', function(el){ el.classList.add('hidden'); });
+            show('no-networks-message', true);
+            return;
+        }
+        var selected = select.value;
+        select.innerHTML = '';
+        networks.forEach(function(val){
+            select.appendChild(networkOption(val));
+        });
+        if(selected) {
+            select.value = selected;
         }
+        showHideFormFields();
+    }
+
+    // Keep the hidden network place holder at the end of the list.
+    function addNetwork(val) {
+        var hidden = select.querySelector('option[data-security="HIDDEN"]');
+        select.insertBefore(networkOption(val), hidden);
+    }
+
+    var state = byId('portal-state');
+    var rendered = state && state.textContent.trim().length !== 0;
+    if(rendered) {
+        state = JSON.parse(state.textContent);
+        showRegcode(state.regcode);
+        showHideFormFields();
+    } else {
+        get('/regcode', showRegcode);
+    }
+
+    var connectMessages = {
+        'queued': 'Waiting for another connection attempt to finish...',
+        'stopping-hotspot': 'Stopping the access point...',
+        'connecting': 'Connecting to ',
+        'connected': 'Connected to ',
+        'failed': 'Could not connect to ',
+        'restarting-hotspot': 'Restarting the access point...',
+        'ready': 'Please try again.'
+    };
+
+    if(window.EventSource) {
+        // The server pushes the network list and connection progress.
+        var source = new EventSource('/events');
+        source.addEventListener('networks', function(ev){
+            showNetworks(JSON.parse(ev.data));
+        });
+        source.addEventListener('networks-diff', function(ev){
+            var diff = JSON.parse(ev.data);
+            diff.removed.forEach(function(val){
+                var option = findOption(val);
+                if(option) {
+                    select.removeChild(option);
+                }
+            });
+            diff.added.forEach(addNetwork);
+            showHideFormFields();
+        });
+        source.addEventListener('connect', function(ev){
+            var status = JSON.parse(ev.data);
+            var message = connectMessages[status.phase] || status.phase;
+            if(/ $/.test(message)) {
+                message += status.ssid;
+            }
+            byId('connect-status').textContent = message;
+            if(status.phase === 'ready') {
+                show('submit-message', false);
+                eachElement('.before-submit', function(el){ el.classList.remove('hidden'); });
+            }
+        });
+    } else if(!rendered) {
+        get('/networks', function(data){
+            showNetworks(data.length === 0 ? [] : JSON.parse(data));
+        });
+    }
+
+    // Ask for a rescan.  The server scans at most every so often and shares
+    // a running scan, so pressing this on many phones costs one scan.
+    var refresh = byId('refresh-networks');
+    refresh.addEventListener('click', function(){
+        var xhr = new XMLHttpRequest();
+        refresh.disabled = true;
+        refresh.textContent = 'Scanning...';
+        xhr.onloadend = function(){
+            refresh.disabled = false;
+            refresh.textContent = 'Refresh';
+            if(xhr.status === 200) {
+                showNetworks(JSON.parse(xhr.responseText).networks);
+            }
+        };
+        xhr.open('POST', '/networks/refresh');
+        xhr.send();
     });
 
-    $('#connect-form').submit(function(ev){
-        $.post('/connect', $('#connect-form').serialize(), function(data){
-            $('.before-submit').hide();
-            $('#submit-message').removeClass('hidden');
+    byId('connect-form').addEventListener('submit', function(ev){
+        var form = byId('connect-form');
+        var fields = Array.prototype.filter.call(form.elements, function(el){
+            return el.name;
+        }).map(function(el){
+            return encodeURIComponent(el.name) + '=' + encodeURIComponent(el.value);
         });
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', '/connect');
+        xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');
+        xhr.onload = function(){
+            // 202: accepted, the progress comes as 'connect' events.
+            if(xhr.status === 202) {
+                eachElement('.before-submit', function(el){ el.classList.add('hidden'); });
+                show('submit-message', true);
+                return;
+            }
+            var message = 'Could not start connecting, please try again.';
+            if(xhr.status === 429) {
+                message = 'Too many attempts, please try again in ' +
+                    (xhr.getResponseHeader('Retry-After') || 30) + ' seconds.';
+            } else if(xhr.status === 503) {
+                message = 'Another connection attempt is in progress, please try again shortly.';
+            }
+            byId('connect-status').textContent = message;
+        };
+        xhr.send(fields.join('&'));
         ev.preventDefault();
     });
 });